@@ -1,16 +1,13 @@
 import numpy as np
 from enum import Enum
-from time import sleep, monotonic
-import pygame
+from time import monotonic
 
 from world import World, Cursor
-from setup import *
-from rules import *
-from settings import *
-from rendering import Screen
-
-# TODO: Stop game if finished
-# TODO: Scoring system
+from setup import Setup
+from rules import Rules
+from settings import Settings
+from scheduler import Scheduler
+from instruments import instruments, timed
 
 
 class Game:
@@ -20,6 +17,10 @@ class Game:
         END = 2
 
     def __init__(self, settings):
+        # pygame (through rendering) only loads once there's a game to show,
+        # so importing this costs no more than the simulation does
+        from rendering import Screen
+
         self.world = None
         self.graphics = []
         self.state = Game.State.SETUP
@@ -29,17 +30,33 @@ class Game:
         self.cursor = Cursor()
 
         self.current_team = 1
+        # seconds to pause on the finished setup before evolving starts
+        self.start_pause = 2.0
+        self.playing_from = None
+        # what was on screen when last rendered, to skip identical frames
+        self.rendered = None
+
+        # the camera: how far arrow keys pan, as a fraction of the screen,
+        # how much each step of the mouse wheel or +/- zooms, and whether
+        # the view is being dragged around with the right mouse button
+        self.pan_fraction = 0.25
+        self.zoom_step = 1.25
+        self.dragging = False
+
+        # cells clicked on since the last update, placed all at once
+        self.clicks = []
 
         # flags
-        self.left_click = False
+        self.quit = False
 
     def clear_input_flags(self):
-        self.left_click = False
+        self.clicks = []
 
     def change_settings(self, settings):
         self.settings = settings
         self.screen.change_res(settings.res)
 
+    @timed("update")
     def update(self):
         # game logic here (setup, running, end, etc)
         if self.state == Game.State.SETUP:
@@ -47,23 +64,14 @@ class Game:
             self.cursor.show()
 
             if self.world.setup.needs_user_input:
-                if self.left_click:
-                    if self.world.is_cell_alive(self.cursor.pos):
-                        # cell is already alive, don't update
-                        pass
-                    else:
-                        # place cell
-                        self.world.set(self.world.setup.place_cells(
-                                                self.world.array,
-                                                self.current_team,
-                                                self.cursor.pos))
-                        if self.current_team == self.world.setup.teams:
-                            self.current_team = 1
-                        else:
-                            self.current_team += 1
+                if self.clicks:
+                    self.place_clicked_cells()
+                    self.cursor.set_team(self.current_team,
+                                         self.world.team_colours)
             else:
                 # no user input, just set it up!
-                self.world.set(self.world.setup.place_cells())
+                self.world.set(self.world.setup.place_cells(
+                                                compact=self.world.compact))
 
             if self.world.setup.setup_complete():
                 # move to PLAYING stage, and reset setup.finished
@@ -71,17 +79,18 @@ class Game:
                 self.state = Game.State.PLAYING
                 self.world.setup.finished = False
                 self.cursor.hide()
-                self.render()
-                sleep(2.0)  # pause with view of startup
-                print("Starting game")
+                # pause with view of startup
+                self.playing_from = monotonic() + self.start_pause
 
         elif self.state == Game.State.PLAYING:
-            time_since_last = monotonic()\
-                              * 1000 - self.world.last_world_update_millis
-            if time_since_last >= self.settings.game_tick_wait:
-                self.world.update(self.settings.game_tick_wait)
-
-            #TODO: Stop the game! (Could do with a world age attribute...)
+            # generations are stepped by tick(), on the scheduler's timestep
+            if self.world.finished():
+                print("Finished after {} generations ({})".format(
+                    self.world.generation,
+                    self.world.history.outcome.name.lower()))
+                for team, score in enumerate(self.world.stats.scores(), 1):
+                    print("  team {}: {}".format(team, score))
+                self.state = Game.State.END
 
         elif self.state == Game.State.END:
             pass
@@ -89,19 +98,96 @@ class Game:
         # at end of update()
         self.clear_input_flags()    # clear all inputs so aren't duplicated
 
+    def place_clicked_cells(self):
+        # place a cell at every click, each for the team whose turn it is.
+        # Clicks that can't be placed (on live cells, or outside the team's
+        # segment) are skipped without using up the turn
+        setup = self.world.setup
+        clicks = np.array(self.clicks).reshape(-1, 2)
+        while len(clicks):
+            teams = (self.current_team - 1 + np.arange(len(clicks))) \
+                % setup.teams + 1
+            results, _, _ = setup.check_placements(self.world.array, clicks,
+                                                   teams)
+            rejected = np.flatnonzero(results != Setup.Placement.PLACED.value)
+            placing = rejected[0] if len(rejected) else len(clicks)
+            if placing:
+                self.world.place(clicks[:placing], teams[:placing])
+                self.current_team = int(teams[placing - 1]) % setup.teams + 1
+            clicks = clicks[placing + 1:]
+
+    def is_ticking(self):
+        return self.state == Game.State.PLAYING \
+               and monotonic() >= self.playing_from
+
+    def tick(self):
+        if instruments.enabled:
+            instruments.tick(self.settings.game_tick_wait)
+        self.world.evolve()
+
+    @timed("get_inputs")
     def get_inputs(self):
-        self.cursor.update(pygame.mouse.get_pos(), self.screen.scaling)
+        import pygame
+        screen = self.screen
         for event in pygame.event.get():
             # must clear events for mouse to update
             # deal with mouse presses and stuff here
             if event.type == pygame.MOUSEBUTTONUP:
                 if event.button == 1:
-                    self.left_click = True
-
-
+                    cell = screen.cell_at(event.pos)
+                    if cell is not None:
+                        self.clicks.append(cell)
+                elif event.button == 3:
+                    self.dragging = False
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
+                self.dragging = True
+            elif event.type == pygame.MOUSEMOTION and self.dragging:
+                screen.pan(*event.rel)
+            elif event.type == pygame.MOUSEWHEEL:
+                screen.zoom(self.zoom_step ** event.y,
+                            around=pygame.mouse.get_pos())
+            elif event.type == pygame.KEYDOWN:
+                self.move_camera(event.key)
+            elif event.type == pygame.KEYUP and event.key == pygame.K_F3:
+                # show or hide where the time goes
+                instruments.toggle()
+                self.rendered = None
+            elif event.type == pygame.QUIT:
+                self.quit = True
+        # after any panning and zooming, so it's under the mouse in the view
+        self.cursor.update(pygame.mouse.get_pos(), screen)
+
+    def move_camera(self, key):
+        import pygame
+        width, height = self.screen.res
+        step_x, step_y = width * self.pan_fraction, height * self.pan_fraction
+        pans = {pygame.K_LEFT: (step_x, 0), pygame.K_RIGHT: (-step_x, 0),
+                pygame.K_UP: (0, step_y), pygame.K_DOWN: (0, -step_y)}
+        if key in pans:
+            self.screen.pan(*pans[key])
+        elif key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+            self.screen.zoom(self.zoom_step)
+        elif key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+            self.screen.zoom(1.0 / self.zoom_step)
+        elif key == pygame.K_HOME:
+            self.screen.reset_view()
+
+    def needs_render(self):
+        return self.rendered != self.on_screen()
+
+    def on_screen(self):
+        # everything that changes what a frame shows
+        return (self.world.version, self.screen.view(), self.cursor.pos,
+                self.cursor.active,
+                instruments.overlay and instruments.snapshots)
+
+    @timed("render")
     def render(self):
+        self.rendered = self.on_screen()
         self.world.render(self.screen)
         self.cursor.render(self.screen)
+        if instruments.overlay:
+            self.screen.draw_text(instruments.overlay_lines())
 
         for g in self.graphics:
             g.render()
@@ -126,11 +212,8 @@ if __name__ == "__main__":
                          Setup.Names.PLACE_CELLS, Setup.Segmented.NONE,
                          )
     #                     num_cells_each=starting_cells_per_team)
-    game.world = World(setup, rules)
+    game.world = World(setup, rules, compact=True)
     game.screen.update_scaling(game.world)
 
-    while True:
-        game.update()
-        game.get_inputs()
-        game.render()
+    Scheduler(settings).run(game)
 
@@ -0,0 +1,112 @@
+import numpy as np
+
+from rules import EvolveBuffers
+
+
+class Batch:
+    """Many independent worlds of the same size, held in one (n, x, y) array
+    of team grids and all evolved by the same handful of NumPy calls.
+
+    Small worlds spend most of their time in per-call overhead, so evolving
+    thousands of them together is far quicker than one World at a time. Each
+    world is watched for finishing on its own (dying out, freezing, or
+    flipping between two states), and finished worlds are dropped from the
+    batch once they make up most of it."""
+    def __init__(self, team_grids, rules, teams=None, prune_fraction=0.5):
+        if team_grids.ndim != 3:
+            raise ValueError("Batches need an (n, x, y) array of team grids")
+        self.rules = rules
+        self.prune_fraction = prune_fraction
+        self.teams = int(team_grids.max()) if teams is None else teams
+        self.generation = 0
+
+        count = team_grids.shape[0]
+        # results for every world, whether still evolving or not
+        self.final_grids = np.array(team_grids)
+        self.finished = np.zeros(count, dtype=bool)
+        self.finished_at = np.full(count, -1, dtype=np.int64)
+
+        # the worlds still evolving, and where they are in the batch
+        self.active = np.arange(count)
+        self.load(self.final_grids)
+
+    @staticmethod
+    def from_setup(setup, count, rules):
+        team_grids = np.stack([setup.place_cells(compact=True)
+                               for _ in range(count)])
+        return Batch(team_grids, rules, teams=setup.teams)
+
+    def load(self, team_grids):
+        self.buffers = EvolveBuffers(team_grids.shape, team_grids.dtype)
+        self.team_grids = self.buffers.load(team_grids, self.rules.borders)
+        self.team_grids = EvolveBuffers.interior(self.team_grids)
+        # the generation before last, to spot worlds flipping between two
+        # states, which is only known after two generations in these buffers
+        self.two_back = np.zeros(team_grids.shape, dtype=team_grids.dtype)
+        self.generations_loaded = 0
+
+    def evolve(self):
+        if len(self.active) == 0:
+            return
+        buffers = self.buffers
+        padded = buffers.load(self.team_grids, self.rules.borders)
+        result_padded = buffers.spare()
+        result_team_grids = EvolveBuffers.interior(result_padded)
+        # the spare buffer still holds the generation before last, until
+        # it's overwritten
+        self.two_back[...] = result_team_grids
+        self.rules.evolve_padded(padded, result_team_grids, buffers)
+        buffers.current = 1 - buffers.current
+        self.generation += 1
+        self.generations_loaded += 1
+
+        old_team_grids, self.team_grids = self.team_grids, result_team_grids
+        self.check_finished(old_team_grids)
+
+    def advance(self, generations):
+        for _ in range(generations):
+            if len(self.active) == 0:
+                break
+            self.evolve()
+
+    def check_finished(self, old_team_grids):
+        new_team_grids = self.team_grids
+        extinct = ~new_team_grids.any(axis=(1, 2))
+        static = (new_team_grids == old_team_grids).all(axis=(1, 2))
+        finished = extinct | static
+        if self.generations_loaded >= 2:
+            finished |= (new_team_grids == self.two_back).all(axis=(1, 2))
+        # worlds waiting to be pruned have already been counted
+        finished &= ~self.finished[self.active]
+        if not finished.any():
+            return
+
+        done = self.active[finished]
+        self.finished[done] = True
+        self.finished_at[done] = self.generation
+        self.final_grids[done] = new_team_grids[finished]
+
+        still_active = ~self.finished[self.active]
+        if np.count_nonzero(still_active) <= \
+                self.prune_fraction * len(self.active):
+            # most of the batch is finished, so stop evolving those worlds
+            self.active = self.active[still_active]
+            self.load(np.array(new_team_grids[still_active]))
+
+    def get_team_grids(self):
+        # every world's latest team grid (frozen at the generation they
+        # finished, for finished worlds)
+        team_grids = self.final_grids.copy()
+        running = ~self.finished[self.active]
+        team_grids[self.active[running]] = self.team_grids[running]
+        return team_grids
+
+    def populations(self):
+        # (n, teams + 1) live cell counts per team, counting every world at
+        # once by offsetting each world's team ids
+        team_grids = self.get_team_grids()
+        count = team_grids.shape[0]
+        offsets = np.arange(count)[:, None, None] * (self.teams + 1)
+        counts = np.bincount((team_grids + offsets).ravel(),
+                             minlength=count * (self.teams + 1))
+        return counts.reshape(count, self.teams + 1)
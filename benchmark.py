@@ -0,0 +1,492 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+import numpy as np
+from time import perf_counter, time
+
+from rules import Rules
+from setup import Setup
+from world import World
+from batched import Batch
+
+# Times the engines against each other, or runs the whole suite of hot paths
+# over a sweep of world sizes, team counts and densities, e.g.:
+#   python benchmark.py suite --sizes 64 256 1024 --json before.json
+#   python benchmark.py suite --sizes 64 256 1024 --compare before.json
+#   python benchmark.py startup --json startup.json
+
+
+def random_team_grid(world_size, teams, density=None, seed=None):
+    # density is the fraction of cells alive, or the random setup's own
+    setup = Setup.create(world_size, teams, Setup.Names.RANDOM, seed=seed)
+    if density is not None:
+        setup.emptiness = emptiness_for(density)
+    return setup.place_cells(compact=True)
+
+
+def emptiness_for(density):
+    # random setups leave emptiness dead cells for every live one
+    return (1.0 - density) / density
+
+
+def time_generations(rules, team_grid, generations):
+    # generations per second, after one untimed generation to set up buffers
+    team_grid = rules.evolve(team_grid)
+    start = perf_counter()
+    for _ in range(generations):
+        team_grid = rules.evolve(team_grid)
+    return generations / (perf_counter() - start), team_grid
+
+
+def benchmark_parallel(world_size, teams, worker_counts, generations):
+    team_grid = random_team_grid(world_size, teams)
+    serial = Rules.create(Rules.Name.COOPERATION)
+    serial_rate, expected = time_generations(serial, team_grid, generations)
+    print("{}x{}, {} teams".format(*world_size, teams))
+    print("  serial: {:8.2f} generations/s".format(serial_rate))
+
+    for workers in worker_counts:
+        parallel = Rules.create(Rules.Name.COOPERATION,
+                                engine=Rules.Engine.PARALLEL, workers=workers)
+        rate, result = time_generations(parallel, team_grid, generations)
+        parallel.close()
+        print("  {:2d} workers: {:8.2f} generations/s, {:5.2f}x{}".format(
+            workers, rate, rate / serial_rate,
+            "" if np.array_equal(result, expected) else " MISMATCH"))
+
+
+def benchmark_batched(count, world_size, teams, generations):
+    setup = Setup.create(world_size, teams, Setup.Names.RANDOM)
+    team_grids = np.stack([setup.place_cells(compact=True)
+                           for _ in range(count)])
+    print("{} worlds of {}x{}, {} teams".format(count, *world_size, teams))
+
+    worlds = []
+    for team_grid in team_grids:
+        world = World(setup, Rules.create(Rules.Name.COOPERATION),
+                      compact=True)
+        world.set(team_grid.copy())
+        worlds.append(world)
+    start = perf_counter()
+    for _ in range(generations):
+        for world in worlds:
+            world.evolve()
+    separate_rate = count * generations / (perf_counter() - start)
+    print("  separate worlds: {:10.1f} world generations/s".format(
+        separate_rate))
+
+    # never prune, so both do the same amount of work
+    batch = Batch(team_grids, Rules.create(Rules.Name.COOPERATION),
+                  teams=teams, prune_fraction=0.0)
+    start = perf_counter()
+    batch.advance(generations)
+    batch_rate = count * generations / (perf_counter() - start)
+    finished = np.count_nonzero(batch.finished)
+    print("  batched:         {:10.1f} world generations/s, {:5.1f}x "
+          "({} of the worlds finished)".format(batch_rate,
+                                               batch_rate / separate_rate,
+                                               finished))
+
+
+class Suite:
+    """The hot paths timed by the suite. Each takes a world size, team count
+    and density, sets up everything it needs, and returns a step function to
+    time and how many operations one step does"""
+    @staticmethod
+    def evolve(world_size, teams, density):
+        rules = Rules.create(Rules.Name.COOPERATION)
+        state = [random_team_grid(world_size, teams, density, seed=0)]
+
+        def step():
+            state[0] = rules.evolve(state[0])
+        return step, 1
+
+    @staticmethod
+    def evolve_one_hot(world_size, teams, density):
+        rules = Rules.create(Rules.Name.COOPERATION)
+        state = [World.world_array_from_team_grid(
+            random_team_grid(world_size, teams, density, seed=0), teams)]
+
+        def step():
+            state[0] = rules.evolve(state[0])
+        return step, 1
+
+    @staticmethod
+    def get_neighbours_array(world_size, teams, density):
+        world_array = World.world_array_from_team_grid(
+            random_team_grid(world_size, teams, density, seed=0), teams)
+        return lambda: Rules.get_neighbours_array(world_array), 1
+
+    @staticmethod
+    def team_grid_from_world_array(world_size, teams, density):
+        world_array = World.world_array_from_team_grid(
+            random_team_grid(world_size, teams, density, seed=0), teams)
+        return lambda: World.team_grid_from_world_array(world_array), 1
+
+    @staticmethod
+    def world_array_from_team_grid(world_size, teams, density):
+        team_grid = random_team_grid(world_size, teams, density, seed=0)
+        return lambda: World.world_array_from_team_grid(team_grid, teams), 1
+
+    @staticmethod
+    def render(world_size, teams, density):
+        # a full redraw of the world every step
+        screen = Suite.screen()
+        world = Suite.world(world_size, teams, density, screen)
+
+        def step():
+            screen.drawn = None
+            world.render(screen)
+        return step, 1
+
+    @staticmethod
+    def render_changes(world_size, teams, density):
+        # a generation evolved and drawn every step, redrawing just what
+        # changed where few enough cells did, as a game does every tick
+        screen = Suite.screen()
+        world = Suite.world(world_size, teams, density, screen)
+        world.render(screen)
+
+        def step():
+            world.evolve()
+            world.render(screen)
+            screen.flip()
+        return step, 1
+
+    @staticmethod
+    def draw_block(world_size, teams, density, blocks=1000):
+        screen = Suite.screen()
+        world = Suite.world(world_size, teams, density, screen)
+        rng = np.random.default_rng(0)
+        positions = list(zip(
+            rng.integers(0, world_size[0], blocks).tolist(),
+            rng.integers(0, world_size[1], blocks).tolist()))
+        colours = [tuple(world.team_colours.palette[team])
+                   for team in rng.integers(1, teams + 1, blocks).tolist()]
+
+        def step():
+            for position, colour in zip(positions, colours):
+                screen.draw_block(position, colour)
+            screen.overlay_rects = []
+        return step, blocks
+
+    @staticmethod
+    def place_cells(world_size, teams, density):
+        setup = Setup.create(world_size, teams, Setup.Names.RANDOM, seed=0)
+        setup.emptiness = emptiness_for(density)
+        return lambda: setup.place_cells(compact=True), 1
+
+    @staticmethod
+    def place_cells_segmented(world_size, teams, density):
+        setup = Setup.create(world_size, teams, Setup.Names.RANDOM,
+                             segmented=Setup.Segmented.EDGES, seed=0)
+        setup.emptiness = emptiness_for(density)
+        setup.get_segment_grid()
+        return lambda: setup.place_cells(compact=True), 1
+
+    # how many bytes per cell and team each one-hot path needs at its
+    # biggest, to skip cases that won't fit in memory
+    one_hot_bytes = {
+        "evolve_one_hot": 24,
+        "get_neighbours_array": 24,
+        "team_grid_from_world_array": 8,
+        "world_array_from_team_grid": 16,
+    }
+
+    names = ("evolve", "evolve_one_hot", "get_neighbours_array",
+             "team_grid_from_world_array", "world_array_from_team_grid",
+             "render", "render_changes", "draw_block", "place_cells",
+             "place_cells_segmented")
+
+    shared_screen = None
+
+    @staticmethod
+    def screen(res=(800, 800)):
+        # one offscreen window for every case, as SDL only has the one
+        if Suite.shared_screen is None:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+            from rendering import Screen
+            Suite.shared_screen = Screen(res)
+        return Suite.shared_screen
+
+    @staticmethod
+    def world(world_size, teams, density, screen):
+        setup = Setup.create(world_size, teams, Setup.Names.RANDOM, seed=0)
+        world = World(setup, Rules.create(Rules.Name.COOPERATION),
+                      compact=True)
+        world.set(random_team_grid(world_size, teams, density, seed=0))
+        screen.update_scaling(world)
+        screen.reset_canvas()
+        return world
+
+
+def measure(step, operations, min_time=0.5, max_repeats=1000):
+    # time step (after one untimed call to warm up) until min_time has
+    # passed, then once more with tracemalloc on for its memory use
+    step()
+    repeats = 0
+    start = perf_counter()
+    elapsed = 0.0
+    while repeats < max_repeats and (repeats == 0 or elapsed < min_time):
+        step()
+        repeats += 1
+        elapsed = perf_counter() - start
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    step()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = elapsed / repeats
+    return {
+        "repeats": repeats,
+        "seconds_per_step": seconds,
+        "operations_per_second": operations / seconds,
+        # the most memory the step had allocated at once, and how much of
+        # that was temporaries it freed again before returning
+        "peak_bytes": peak - before,
+        "temporary_bytes_per_operation": (peak - after) / operations,
+        "retained_bytes": after - before,
+    }
+
+
+def run_suite(names, sizes, team_counts, densities, max_bytes=1 << 30,
+              min_time=0.5, report=print):
+    results = []
+    for name in names:
+        benchmark = getattr(Suite, name)
+        for size in sizes:
+            for teams in team_counts:
+                for density in densities:
+                    case = {"name": name, "size": size, "teams": teams,
+                            "density": density}
+                    needed = size * size * teams * \
+                        Suite.one_hot_bytes.get(name, 0)
+                    if needed > max_bytes:
+                        case["skipped"] = "needs about {} MiB".format(
+                            needed >> 20)
+                    else:
+                        step, operations = benchmark((size, size), teams,
+                                                     density)
+                        case.update(measure(step, operations, min_time))
+                        del step
+                    results.append(case)
+                    report(describe(case))
+    return results
+
+
+def describe(case):
+    where = "{:28} {}".format(case["name"], case_settings(case))
+    if "skipped" in case:
+        return where + "  skipped, " + case["skipped"]
+    return where + "  {:12.2f}/s {:10.2f} MiB peak {:12.1f} B/op".format(
+        case["operations_per_second"], case["peak_bytes"] / (1 << 20),
+        case["temporary_bytes_per_operation"])
+
+
+def case_settings(case):
+    return "{:5}^2 {:2} teams {:4.2f}".format(case["size"], case["teams"],
+                                             case["density"])
+
+
+def environment():
+    # enough to tell apart results from different commits and machines
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "time": time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    # the cases that have got more than tolerance slower than in baseline,
+    # as (case, old rate, new rate)
+    def key(case):
+        return case["name"], case["size"], case["teams"], case["density"]
+
+    old_rates = {key(case): case["operations_per_second"]
+                 for case in baseline["results"] if "skipped" not in case}
+    slower = []
+    for case in results:
+        old_rate = old_rates.get(key(case))
+        if old_rate is None or "skipped" in case:
+            continue
+        if case["operations_per_second"] < old_rate * (1.0 - tolerance):
+            slower.append((case, old_rate, case["operations_per_second"]))
+    return slower
+
+
+# what each kind of cold start runs in a fresh interpreter, printing how long
+# its imports took and how long until it had evolved or drawn something
+startup_scripts = {
+    "core": """
+start = perf_counter()
+from world import World
+from rules import Rules
+from setup import Setup
+imported = perf_counter()
+Rules.create(Rules.Name.COOPERATION).evolve(
+    Setup.create((64, 64), 4, Setup.Names.RANDOM).place_cells(compact=True))
+""",
+    "headless": """
+start = perf_counter()
+from headless import run_match
+imported = perf_counter()
+run_match((64, 64), 4, 1)
+""",
+    "gui": """
+start = perf_counter()
+from MultiplayerConway import Game, World, Setup, Rules, Settings
+imported = perf_counter()
+game = Game(Settings((400, 400), 100.0))
+game.world = World(Setup.create((64, 64), 4, Setup.Names.RANDOM),
+                   Rules.create(Rules.Name.COOPERATION), compact=True)
+game.screen.update_scaling(game.world)
+game.update()
+game.render()
+""",
+}
+
+
+def time_startup(kind, repeats=5):
+    # median seconds for the whole process, its imports, and until it was
+    # ready, with the modules it imported that only games should need
+    script = "import json, sys\nfrom time import perf_counter\n" + \
+        startup_scripts[kind] + \
+        "ready = perf_counter()\n" \
+        "print(json.dumps([imported - start, ready - start, " \
+        "[name for name in ('pygame', 'colours', 'rendering') " \
+        "if name in sys.modules]]))\n"
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy",
+               PYGAME_HIDE_SUPPORT_PROMPT="1")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    processes, imports, readies = [], [], []
+    for _ in range(repeats):
+        start = perf_counter()
+        output = subprocess.run([sys.executable, "-c", script], env=env,
+                                cwd=directory, capture_output=True,
+                                text=True, check=True).stdout
+        processes.append(perf_counter() - start)
+        imported, ready, loaded = json.loads(output.strip().splitlines()[-1])
+        imports.append(imported)
+        readies.append(ready)
+    return {
+        "kind": kind,
+        "repeats": repeats,
+        "process_seconds": float(np.median(processes)),
+        "import_seconds": float(np.median(imports)),
+        "ready_seconds": float(np.median(readies)),
+        "game_modules": loaded,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time evolving worlds with the different engines")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parallel = commands.add_parser(
+        "parallel", help="serial against parallel evolving of one big world")
+    parallel.add_argument("--size", type=int, nargs=2, default=(8192, 8192))
+    parallel.add_argument("--teams", type=int, default=8)
+    parallel.add_argument("--generations", type=int, default=10)
+    parallel.add_argument("--workers", type=int, nargs="+",
+                          default=(1, 2, 4, 8, 16, 32))
+
+    batched = commands.add_parser(
+        "batched", help="separate World objects against one Batch")
+    batched.add_argument("--count", type=int, default=10000)
+    batched.add_argument("--size", type=int, nargs=2, default=(64, 64))
+    batched.add_argument("--teams", type=int, default=4)
+    batched.add_argument("--generations", type=int, default=20)
+
+    suite = commands.add_parser(
+        "suite", help="time the hot paths over a sweep of world sizes, team "
+                      "counts and densities")
+    suite.add_argument("--only", nargs="+", choices=Suite.names,
+                       default=Suite.names, metavar="NAME",
+                       help="benchmarks to run, of: " + ", ".join(Suite.names))
+    suite.add_argument("--sizes", type=int, nargs="+",
+                       default=(64, 256, 1024, 4096, 8192))
+    suite.add_argument("--teams", type=int, nargs="+", default=(2, 8, 32))
+    suite.add_argument("--densities", type=float, nargs="+",
+                       default=(0.1, 0.2, 0.5))
+    suite.add_argument("--min-time", type=float, default=0.5,
+                       help="seconds to spend timing each case")
+    suite.add_argument("--max-mib", type=int, default=1024,
+                       help="skip one-hot cases needing more memory than "
+                            "this")
+    suite.add_argument("--json", metavar="PATH",
+                       help="save the results here")
+    suite.add_argument("--compare", metavar="PATH",
+                       help="list cases slower than in these saved results")
+    suite.add_argument("--tolerance", type=float, default=0.1,
+                       help="fraction slower a case can get before it's "
+                            "listed by --compare")
+    startup = commands.add_parser(
+        "startup", help="time cold starts of the simulation core, headless "
+                        "matches and the game")
+    startup.add_argument("--kinds", nargs="+", choices=sorted(startup_scripts),
+                         default=("core", "headless", "gui"))
+    startup.add_argument("--repeats", type=int, default=5)
+    startup.add_argument("--json", metavar="PATH",
+                         help="save the results here")
+    args = parser.parse_args(argv)
+
+    if args.command == "parallel":
+        benchmark_parallel(tuple(args.size), args.teams, args.workers,
+                           args.generations)
+    elif args.command == "batched":
+        benchmark_batched(args.count, tuple(args.size), args.teams,
+                          args.generations)
+    elif args.command == "startup":
+        results = []
+        for kind in args.kinds:
+            result = time_startup(kind, args.repeats)
+            results.append(result)
+            print("{:8} process {:7.1f}ms, imports {:7.1f}ms, ready {:7.1f}ms"
+                  ", loaded {}".format(
+                      kind, result["process_seconds"] * 1000.0,
+                      result["import_seconds"] * 1000.0,
+                      result["ready_seconds"] * 1000.0,
+                      result["game_modules"]))
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump({"environment": environment(),
+                           "startup": results}, file, indent=1)
+    else:
+        results = run_suite(args.only, args.sizes, args.teams,
+                            args.densities, args.max_mib << 20,
+                            args.min_time)
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump({"environment": environment(),
+                           "results": results}, file, indent=1)
+        if args.compare:
+            with open(args.compare) as file:
+                baseline = json.load(file)
+            slower = compare(results, baseline, args.tolerance)
+            for case, old_rate, new_rate in slower:
+                print("slower: {} {} ({:.2f}/s, was {:.2f}/s)".format(
+                    case["name"], case_settings(case), new_rate, old_rate))
+            print("{} of {} cases slower than {}".format(
+                len(slower), len(results), args.compare))
+
+
+if __name__ == "__main__":
+    main()
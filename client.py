@@ -0,0 +1,66 @@
+import asyncio
+import numpy as np
+
+from protocol import Message, Role, Phase, pack, read_message, \
+    decode_update, join_format, place_format, welcome_format, phase_format
+
+
+class Client:
+    """A client of a match server, keeping its own copy of the world up to
+    date from the updates it's sent. Used by scripted players, spectators
+    and tests, all without a window"""
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.team = 0
+        self.world_size = None
+        self.teams = 0
+        self.cells_each = 0
+        self.phase = Phase.SETUP
+        self.generation = 0
+        self.team_grid = None
+        self.errors = []
+
+    async def connect(self, host, port, role=Role.SPECTATOR):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(pack(Message.JOIN, join_format.pack(role.value)))
+        kind, payload = await read_message(self.reader)
+        if kind != Message.WELCOME:
+            raise ConnectionError("Expected a welcome, got {}"
+                                  .format(kind.name))
+        team, world_x, world_y, self.teams, phase, self.cells_each = \
+            welcome_format.unpack(payload)
+        self.team = team
+        self.phase = Phase(phase)
+        self.world_size = (world_x, world_y)
+        self.team_grid = np.zeros(self.world_size, dtype=np.uint16)
+        return self
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def place(self, x, y):
+        self.writer.write(pack(Message.PLACE, place_format.pack(x, y)))
+        await self.writer.drain()
+
+    async def receive(self):
+        # read and apply one message, returning its kind
+        kind, payload = await read_message(self.reader)
+        if kind in (Message.KEYFRAME, Message.DIFF):
+            # keyframes are just diffs covering every cell
+            self.generation, indices, teams = decode_update(payload)
+            self.team_grid.ravel()[indices] = teams
+        elif kind == Message.PHASE:
+            phase, self.generation = phase_format.unpack(payload)
+            self.phase = Phase(phase)
+        elif kind == Message.ERROR:
+            self.errors.append(payload.decode())
+        return kind
+
+    async def run_until(self, phase=Phase.END):
+        while self.phase != phase:
+            await self.receive()
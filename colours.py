@@ -1,3 +1,4 @@
+import numpy as np
 from pygame import Color
 
 
@@ -23,9 +24,18 @@ class Colours:
                 self.teams[t] = self.shift_colour(prev_cycle_colour,
                                                   sat_multiplier=0.6)
 
+        self.palette = self.make_palette()
+
     def get_team_colour(self, team):
         return self.teams[team]
 
+    def make_palette(self):
+        # lookup table of RGB colours, indexed by team id
+        palette = np.zeros((max(self.teams) + 1, 3), dtype=np.uint8)
+        for team, colour in self.teams.items():
+            palette[team] = colour.r, colour.g, colour.b
+        return palette
+
     @staticmethod
     def shift_colour(colour,
                      hue_multiplier=1.0, sat_multiplier=1.0,
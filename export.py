@@ -0,0 +1,230 @@
+import argparse
+import os
+import queue
+import struct
+import subprocess
+import threading
+import zlib
+import numpy as np
+
+from world import World
+from setup import Setup
+from rules import Rules
+
+# Streams generations out of a world without a window, e.g.:
+#   python export.py --size 200 200 --generations 500 --scale 4 --png frames
+#   python export.py --size 200 200 --scale 4 --pipe "ffmpeg -f rawvideo
+#       -pix_fmt rgb24 -s 800x800 -r 30 -i - match.mp4"
+
+
+class Sink:
+    """Somewhere to send a stream of generations, written out on a thread of
+    its own.
+
+    Generations wait in a queue of at most max_queued, and put() blocks while
+    it's full, so a slow sink holds back evolving instead of buffering up
+    ever more of the match."""
+    def __init__(self, max_queued=8):
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put(self, generation, array):
+        if self.error is not None:
+            raise self.error
+        # copied, as streamed arrays are reused for the next generation
+        self.queue.put((generation, np.array(array)))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining so put() never blocks forever
+                continue
+            try:
+                self.write(*item)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.finish()
+        if self.error is not None:
+            raise self.error
+
+    def write(self, generation, array):
+        raise NotImplementedError("This class shouldn't be used,"
+                                  "it is an abstract base class")
+
+    def finish(self):
+        pass
+
+
+class PngSink(Sink):
+    """Writes each RGB frame as a numbered PNG file"""
+    def __init__(self, directory, pattern="{:06d}.png", max_queued=8):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pattern = pattern
+        Sink.__init__(self, max_queued)
+
+    def write(self, generation, frame):
+        path = os.path.join(self.directory, self.pattern.format(generation))
+        with open(path, "wb") as file:
+            file.write(PngSink.encode(frame))
+
+    @staticmethod
+    def encode(frame):
+        # a (height, width, 3) uint8 array as an 8-bit RGB PNG, with every row
+        # unfiltered
+        height, width, _ = frame.shape
+        rows = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+        rows[:, 1:] = frame.reshape(height, width * 3)
+
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + \
+                struct.pack(">I", zlib.crc32(kind + data))
+
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + \
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)) + \
+            chunk(b"IEND", b"")
+
+
+class NpySink(Sink):
+    """Writes generations to .npy files of chunk_size stacked arrays each,
+    named after the first generation in them, with the generations in a
+    matching _generations.npy file"""
+    def __init__(self, directory, chunk_size=256, max_queued=8):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.chunk = None
+        self.generations = np.zeros(chunk_size, dtype=np.int64)
+        self.count = 0
+        Sink.__init__(self, max_queued)
+
+    def write(self, generation, array):
+        if self.chunk is None:
+            # one chunk's worth of space, reused for every chunk
+            self.chunk = np.zeros((self.chunk_size,) + array.shape,
+                                  dtype=array.dtype)
+        self.chunk[self.count] = array
+        self.generations[self.count] = generation
+        self.count += 1
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        name = os.path.join(self.directory,
+                            "{:09d}".format(self.generations[0]))
+        np.save(name + ".npy", self.chunk[:self.count])
+        np.save(name + "_generations.npy", self.generations[:self.count])
+        self.count = 0
+
+    def finish(self):
+        self.flush()
+
+
+class PipeSink(Sink):
+    """Pipes raw RGB frames into the stdin of another program, such as a
+    video encoder"""
+    def __init__(self, command, max_queued=8):
+        self.process = subprocess.Popen(
+            command, shell=isinstance(command, str), stdin=subprocess.PIPE)
+        Sink.__init__(self, max_queued)
+
+    def write(self, generation, frame):
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        except BrokenPipeError:
+            raise RuntimeError("Exporting pipe stopped reading frames, and "
+                               "exited with code {}"
+                               .format(self.process.wait()))
+
+    def finish(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # it exited with frames still buffered, which write() raises for
+            # if it noticed first
+            pass
+        code = self.process.wait()
+        if code != 0 and self.error is None:
+            self.error = RuntimeError("Exporting pipe exited with code {}"
+                                      .format(code))
+
+
+def export(world, sinks, generations=None, output=World.Stream.FRAMES,
+           scale=1, until_finished=True):
+    # stream generations from world into every sink, returning how many
+    try:
+        count = 0
+        for generation, array in world.stream(generations, output, scale,
+                                              until_finished):
+            for sink in sinks:
+                sink.put(generation, array)
+            count += 1
+        return count
+    finally:
+        for sink in sinks:
+            sink.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export a match's generations without a display")
+    parser.add_argument("--size", type=int, nargs=2, default=(100, 100),
+                        metavar=("X", "Y"))
+    parser.add_argument("--teams", type=int, default=4)
+    parser.add_argument("--rules", default="cooperation")
+    parser.add_argument("--borders", default="dead")
+    parser.add_argument("--generations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--scale", type=int, default=1,
+                        help="pixels per cell in exported frames")
+    parser.add_argument("--grids", action="store_true",
+                        help="export team grids instead of RGB frames")
+    parser.add_argument("--png", metavar="DIR")
+    parser.add_argument("--npy", metavar="DIR")
+    parser.add_argument("--pipe", metavar="COMMAND")
+    args = parser.parse_args(argv)
+
+    setup = Setup.create(tuple(args.size), args.teams, Setup.Names.RANDOM,
+                         seed=args.seed)
+    rules = Rules.create(Rules.Name[args.rules.upper()],
+                         borders=Rules.Borders[args.borders.upper()])
+    world = World(setup, rules, compact=True)
+    world.set(setup.place_cells(compact=True))
+
+    output = World.Stream.TEAM_GRIDS if args.grids else World.Stream.FRAMES
+    if args.grids and (args.png or args.pipe):
+        parser.error("only --npy can take team grids")
+    sinks = []
+    if args.png:
+        sinks.append(PngSink(args.png))
+    if args.npy:
+        sinks.append(NpySink(args.npy))
+    if args.pipe:
+        sinks.append(PipeSink(args.pipe))
+    if not sinks:
+        parser.error("give at least one of --png, --npy or --pipe")
+
+    count = export(world, sinks, args.generations, output, args.scale)
+    print("Exported {} generations".format(count))
+
+
+if __name__ == "__main__":
+    main()
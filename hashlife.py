@@ -0,0 +1,351 @@
+import numpy as np
+
+from rules import Rules, EvolveBuffers
+
+
+class Node:
+    """A canonical quadtree node covering a 2**level square of cells.
+
+    Level 0 nodes are single cells holding a team id in value, everything
+    above is made of four children. Nodes are shared, so identical regions
+    anywhere in space or time are only ever stored (and evolved) once."""
+    __slots__ = ("level", "nw", "ne", "sw", "se", "value",
+                 "population", "walls")
+
+    def __init__(self, level, nw=None, ne=None, sw=None, se=None, value=0,
+                 population=0, walls=0):
+        self.level = level
+        self.nw = nw
+        self.ne = ne
+        self.sw = sw
+        self.se = se
+        self.value = value
+        self.population = population
+        self.walls = walls
+
+    def is_empty(self):
+        return self.population == 0 and self.walls == 0
+
+    def is_wall(self):
+        return self.walls == 4 ** self.level
+
+
+class Hashlife:
+    """Memoized quadtree engine, for jumping a world forward by many
+    generations at once.
+
+    Wraps the Rules that say how cells evolve, which are only ever asked to
+    evolve small blocks (and only once per distinct block). Everything outside
+    the world is filled with wall cells, which never change and count as dead,
+    so bounded worlds behave exactly as they do with the dense engine.
+
+    The node cache is cleared whenever it grows past max_nodes, which only
+    costs speed: cached results are an optimisation, never needed for
+    correctness."""
+    # team id used for cells beyond the edge of the world
+    WALL = np.iinfo(np.uint16).max
+    # nodes this small are evolved directly rather than recursing further
+    LEAF_LEVEL = 4
+
+    def __init__(self, rules, max_nodes=1000000):
+        if rules.borders != Rules.Borders.DEAD:
+            raise ValueError("Hashlife only supports worlds with dead "
+                             "borders")
+        self.rules = rules
+        self.max_nodes = max_nodes
+
+        self.nodes = {}
+        self.results = {}
+        self.cells = {}
+        self.uniform_nodes = {}
+        self.leaf_buffers = {}
+        self.evictions = 0
+
+        # the quadtree for the last grid returned, so stepping the same world
+        # again needn't rebuild it
+        self.root = None
+        self.offset = 0
+        self.shape = None
+        self.result = None
+        # results are built whole from the quadtree, so which cells changed
+        # isn't known without comparing them
+        self.changed_cells = None
+
+    @property
+    def borders(self):
+        return self.rules.borders
+
+    @borders.setter
+    def borders(self, borders):
+        if borders != Rules.Borders.DEAD:
+            raise ValueError("Hashlife only supports worlds with dead "
+                             "borders")
+        self.rules.borders = borders
+
+    def evolve(self, world_array):
+        return self.advance(world_array, 1)
+
+    def evolve_team_grid(self, team_grid):
+        return self.advance(team_grid, 1)
+
+    def forget(self):
+        # the last grid returned was changed in place by something other than
+        # evolving, so its quadtree has to be built again
+        self.result = None
+
+    def evolve_padded(self, padded, out, buffers, changed=False):
+        return self.rules.evolve_padded(padded, out, buffers, changed)
+
+    def advance(self, world_array, generations):
+        if world_array.ndim == 3:
+            from world import World
+            teams = world_array.shape[2]
+            team_grid = self.advance(
+                World.team_grid_from_world_array(world_array), generations)
+            world_array = np.zeros(world_array.shape, dtype=world_array.dtype)
+            for t in range(teams):
+                world_array[:, :, t] = team_grid == t + 1
+            return world_array
+
+        if world_array is not self.result:
+            self.load(world_array)
+        # 2**j generations for each bit j of generations
+        j = 0
+        while generations >> j:
+            if (generations >> j) & 1:
+                self.step(j)
+            j += 1
+
+        self.result = self.to_array(world_array.dtype)
+        return self.result
+
+    def step(self, j):
+        # advance the root by 2**j generations, leaving it the same size and in
+        # the same place. successor() needs a level j + 2 node and returns its
+        # centre, so grow the root around its centre first
+        while self.root.level < j + 1:
+            self.offset += 2 ** (self.root.level - 1)
+            self.root = self.centred(self.root)
+        self.root = self.successor(self.centred(self.root), j)
+
+        # then shrink it back down while the world still fits in its centre,
+        # as there is nothing but wall around it
+        x, y = self.shape
+        while self.root.level > self.LEAF_LEVEL:
+            quarter = 2 ** (self.root.level - 2)
+            if self.offset < quarter \
+                    or self.offset + max(x, y) > 3 * quarter:
+                break
+            root = self.root
+            self.root = self.join(root.nw.se, root.ne.sw,
+                                  root.sw.ne, root.se.nw)
+            self.offset -= quarter
+
+    def load(self, team_grid):
+        x, y = team_grid.shape
+        level = max(self.LEAF_LEVEL, int(np.ceil(np.log2(max(x, y)))))
+        size = 2 ** level
+        grid = np.full((size, size), self.WALL, dtype=np.uint16)
+        grid[:x, :y] = team_grid
+
+        # build the tree bottom up, a whole level at a time, only joining each
+        # distinct group of four children once
+        values, ids = np.unique(grid, return_inverse=True)
+        ids = ids.reshape(grid.shape)
+        nodes = [self.cell(int(value)) for value in values]
+        while ids.shape[0] > 1:
+            quads = np.stack((ids[0::2, 0::2], ids[0::2, 1::2],
+                              ids[1::2, 0::2], ids[1::2, 1::2]), axis=-1)
+            quads, ids = np.unique(quads.reshape(-1, 4), axis=0,
+                                   return_inverse=True)
+            ids = ids.reshape(size // 2, size // 2)
+            size //= 2
+            nodes = [self.join(nodes[nw], nodes[ne], nodes[sw], nodes[se])
+                     for nw, ne, sw, se in quads]
+
+        self.root = nodes[0]
+        self.offset = 0
+        self.shape = team_grid.shape
+
+    def to_array(self, dtype):
+        size = 2 ** self.root.level
+        grid = np.zeros((size, size), dtype=np.uint16)
+        self.fill(grid, self.root, 0, 0)
+        x, y = self.shape
+        grid = grid[self.offset:self.offset + x, self.offset:self.offset + y]
+        return grid.astype(dtype)
+
+    def fill(self, grid, node, x, y):
+        if node.is_empty():
+            return
+        size = 2 ** node.level
+        if node.is_wall():
+            grid[x:x + size, y:y + size] = self.WALL
+        elif node.level == 0:
+            grid[x, y] = node.value
+        else:
+            half = size // 2
+            self.fill(grid, node.nw, x, y)
+            self.fill(grid, node.ne, x, y + half)
+            self.fill(grid, node.sw, x + half, y)
+            self.fill(grid, node.se, x + half, y + half)
+
+    def cell(self, value):
+        if value not in self.cells:
+            self.cells[value] = Node(0, value=value,
+                                     population=int(0 < value < self.WALL),
+                                     walls=int(value == self.WALL))
+        return self.cells[value]
+
+    def join(self, nw, ne, sw, se):
+        key = (nw, ne, sw, se)
+        node = self.nodes.get(key)
+        if node is None:
+            if len(self.nodes) >= self.max_nodes:
+                self.evict()
+            node = Node(nw.level + 1, nw, ne, sw, se,
+                        population=(nw.population + ne.population
+                                    + sw.population + se.population),
+                        walls=nw.walls + ne.walls + sw.walls + se.walls)
+            self.nodes[key] = node
+        return node
+
+    def evict(self):
+        self.nodes.clear()
+        self.results.clear()
+        self.uniform_nodes.clear()
+        self.evictions += 1
+
+    def uniform(self, value, level):
+        # a node of the given level with every cell the same
+        key = (value, level)
+        if key not in self.uniform_nodes:
+            if level == 0:
+                node = self.cell(value)
+            else:
+                child = self.uniform(value, level - 1)
+                node = self.join(child, child, child, child)
+            self.uniform_nodes[key] = node
+        return self.uniform_nodes[key]
+
+    def centred(self, node):
+        # a node one level up, with node in the middle and walls around it
+        wall = self.uniform(self.WALL, node.level - 1)
+        return self.join(self.join(wall, wall, wall, node.nw),
+                         self.join(wall, wall, node.ne, wall),
+                         self.join(wall, node.sw, wall, wall),
+                         self.join(node.se, wall, wall, wall))
+
+    def successor(self, node, j):
+        # the centre half of node, 2**j generations on (j <= node.level - 2)
+        if node.is_empty():
+            return self.uniform(0, node.level - 1)
+        if node.is_wall():
+            return self.uniform(self.WALL, node.level - 1)
+        key = (node, j)
+        result = self.results.get(key)
+        if result is not None:
+            return result
+
+        if node.level <= self.LEAF_LEVEL:
+            result = self.evolve_leaf(node, j)
+        else:
+            nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+            # for a full 2**(level - 2) step, sub nodes go half as far twice
+            sub_j = min(j, node.level - 3)
+            # the nine overlapping sub nodes, each half the size of node
+            c1 = self.successor(nw, sub_j)
+            c2 = self.successor(self.join(nw.ne, ne.nw, nw.se, ne.sw), sub_j)
+            c3 = self.successor(ne, sub_j)
+            c4 = self.successor(self.join(nw.sw, nw.se, sw.nw, sw.ne), sub_j)
+            c5 = self.successor(self.join(nw.se, ne.sw, sw.ne, se.nw), sub_j)
+            c6 = self.successor(self.join(ne.sw, ne.se, se.nw, se.ne), sub_j)
+            c7 = self.successor(sw, sub_j)
+            c8 = self.successor(self.join(sw.ne, se.nw, sw.se, se.sw), sub_j)
+            c9 = self.successor(se, sub_j)
+            if j < node.level - 2:
+                # sub nodes have already been advanced far enough, just take
+                # their centres
+                result = self.join(
+                    self.join(c1.se, c2.sw, c4.ne, c5.nw),
+                    self.join(c2.se, c3.sw, c5.ne, c6.nw),
+                    self.join(c4.se, c5.sw, c7.ne, c8.nw),
+                    self.join(c5.se, c6.sw, c8.ne, c9.nw))
+            else:
+                result = self.join(
+                    self.successor(self.join(c1, c2, c4, c5), sub_j),
+                    self.successor(self.join(c2, c3, c5, c6), sub_j),
+                    self.successor(self.join(c4, c5, c7, c8), sub_j),
+                    self.successor(self.join(c5, c6, c8, c9), sub_j))
+
+        self.results[key] = result
+        return result
+
+    def evolve_leaf(self, node, j):
+        # a small node's centre half 2**j generations on, evolved directly by
+        # the wrapped rules. Each generation uses the block as the padded grid
+        # around a result two cells smaller, with walls cleared to dead first
+        # and put back afterwards
+        block = np.zeros((2 ** node.level, 2 ** node.level), dtype=np.uint16)
+        self.fill(block, node, 0, 0)
+        walls = block == self.WALL
+        for _ in range(2 ** j):
+            block[walls] = 0
+            result = np.empty((block.shape[0] - 2, block.shape[1] - 2),
+                              dtype=np.uint16)
+            self.rules.evolve_padded(block, result,
+                                     self.leaf_buffers_for(result.shape))
+            walls = walls[1:-1, 1:-1]
+            result[walls] = self.WALL
+            block = result
+
+        quarter = 2 ** (node.level - 2)
+        trim = quarter - 2 ** j
+        if trim:
+            block = block[trim:-trim, trim:-trim]
+        return self.build_small(block)
+
+    def leaf_buffers_for(self, shape):
+        if shape not in self.leaf_buffers:
+            self.leaf_buffers[shape] = EvolveBuffers(shape, np.uint16,
+                                                     double_buffered=False)
+        return self.leaf_buffers[shape]
+
+    def build_small(self, block):
+        if block.shape[0] == 1:
+            return self.cell(int(block[0, 0]))
+        half = block.shape[0] // 2
+        return self.join(self.build_small(block[:half, :half]),
+                         self.build_small(block[:half, half:]),
+                         self.build_small(block[half:, :half]),
+                         self.build_small(block[half:, half:]))
+
+
+if __name__ == "__main__":
+    # check against the dense engine on random boards
+    from time import monotonic
+    from setup import Setup
+
+    for world_size, teams, generations in (((37, 53), 2, 100),
+                                           ((64, 64), 4, 4096),
+                                           ((100, 80), 8, 1000)):
+        setup = Setup.create(world_size, teams, Setup.Names.RANDOM)
+        team_grid = setup.place_cells(compact=True)
+        dense = Rules.create(Rules.Name.COOPERATION)
+        hashlife = Rules.create(Rules.Name.COOPERATION,
+                                engine=Rules.Engine.HASHLIFE)
+
+        start = monotonic()
+        expected = team_grid
+        for _ in range(generations):
+            expected = dense.evolve(expected)
+        dense_time = monotonic() - start
+
+        start = monotonic()
+        result = hashlife.advance(team_grid, generations)
+        hashlife_time = monotonic() - start
+
+        print(world_size, teams, "teams,", generations, "generations:",
+              "match" if np.array_equal(result, expected) else "MISMATCH",
+              "(dense {:.3f}s, hashlife {:.3f}s)".format(dense_time,
+                                                        hashlife_time))
@@ -0,0 +1,131 @@
+import argparse
+import json
+from time import perf_counter
+
+from world import World
+from setup import Setup
+from rules import Rules
+from replay import ReplayWriter
+
+# Runs matches without a window, and without ever importing pygame, e.g.:
+#   python headless.py --size 256 256 --teams 4 --generations 1000 --seed 1
+
+
+def run_match(world_size, teams, generations, setup_name=Setup.Names.RANDOM,
+              segmented=Setup.Segmented.NONE,
+              rules_name=Rules.Name.COOPERATION, borders=Rules.Borders.DEAD,
+              engine=Rules.Engine.DENSE,
+              seed=None, stop_when_finished=True, record=None):
+    """Set up and evolve a whole match, returning its final populations.
+
+    If record is a path, the match is saved there as a replay."""
+    setup = Setup.create(world_size, teams, setup_name, segmented, seed=seed)
+    if setup.needs_user_input:
+        raise ValueError("{} needs players to place cells, so can't be run "
+                         "headless".format(setup_name.name))
+    rules = Rules.create(rules_name, borders=borders, engine=engine)
+
+    world = World(setup, rules, compact=True)
+    world.set(setup.place_cells(compact=True))
+
+    writer = None
+    if record is not None:
+        writer = ReplayWriter.for_world(record, world, rules_name, seed)
+        writer.record(world)
+
+    start = perf_counter()
+    if engine == Rules.Engine.HASHLIFE:
+        world.advance(generations)
+        if writer is not None:
+            writer.record(world)
+    else:
+        for _ in range(generations):
+            world.evolve()
+            if writer is not None:
+                writer.record(world)
+            if world.finished() and stop_when_finished:
+                break
+    seconds = perf_counter() - start
+    if writer is not None:
+        writer.close()
+
+    populations = world.stats.population
+    return {
+        "world_size": list(world_size),
+        "teams": teams,
+        "setup": setup_name.name,
+        "rules": rules_name.name,
+        "borders": borders.name,
+        "engine": engine.name,
+        "seed": seed,
+        "generations": world.generation,
+        "outcome": world.history.outcome.name,
+        "period": world.history.period,
+        "seconds": seconds,
+        "generations_per_second":
+            world.generation / seconds if seconds else None,
+        "populations": {team: int(populations[team])
+                        for team in range(1, teams + 1)},
+        "scores": {team: int(score)
+                   for team, score in enumerate(world.stats.scores(), 1)},
+    }
+
+
+def enum_argument(enum):
+    # lets enums be given by name on the command line, e.g. --rules violence
+    def parse(name):
+        try:
+            return enum[name.upper()]
+        except KeyError:
+            raise argparse.ArgumentTypeError(
+                "choose from " + ", ".join(e.name.lower() for e in enum))
+    return parse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a match without a display")
+    parser.add_argument("--size", type=int, nargs=2, default=(100, 100),
+                        metavar=("X", "Y"))
+    parser.add_argument("--teams", type=int, default=4)
+    parser.add_argument("--setup", type=enum_argument(Setup.Names),
+                        default=Setup.Names.RANDOM)
+    parser.add_argument("--segmented", type=enum_argument(Setup.Segmented),
+                        default=Setup.Segmented.NONE)
+    parser.add_argument("--rules", type=enum_argument(Rules.Name),
+                        default=Rules.Name.COOPERATION)
+    parser.add_argument("--borders", type=enum_argument(Rules.Borders),
+                        default=Rules.Borders.DEAD)
+    parser.add_argument("--engine", type=enum_argument(Rules.Engine),
+                        default=Rules.Engine.DENSE)
+    parser.add_argument("--generations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--keep-going", action="store_true",
+                        help="evolve every generation, even once the match "
+                             "has finished")
+    parser.add_argument("--record", metavar="PATH",
+                        help="save a replay of the match")
+    parser.add_argument("--json", action="store_true",
+                        help="print the result as a line of JSON")
+    args = parser.parse_args(argv)
+
+    result = run_match(tuple(args.size), args.teams, args.generations,
+                       setup_name=args.setup, segmented=args.segmented,
+                       rules_name=args.rules, borders=args.borders,
+                       engine=args.engine, seed=args.seed,
+                       stop_when_finished=not args.keep_going,
+                       record=args.record)
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print("{} generations in {:.3f}s ({:.1f} generations/s), {}".format(
+            result["generations"], result["seconds"],
+            result["generations_per_second"] or 0.0,
+            result["outcome"].lower()))
+        for team, population in result["populations"].items():
+            print("  team {}: {}".format(team, population))
+
+
+if __name__ == "__main__":
+    main()
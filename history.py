@@ -0,0 +1,113 @@
+import numpy as np
+from collections import deque
+from enum import Enum
+
+
+class History:
+    """Watches a world's generations for its match being over: every cell
+    dead, nothing changing any more, or the same states coming round again.
+
+    Each state is summed up by a 64-bit Zobrist hash, the XOR of a random key
+    for every live cell and its team. XOR undoes itself, so the hash is
+    updated from each generation's diff instead of rehashing the whole world,
+    and the hashes of the last max_period generations are enough to spot
+    anything oscillating with a period up to that."""
+    class Outcome(Enum):
+        RUNNING = 0
+        EXTINCT = 1     # no live cells left
+        STATIC = 2      # nothing changes from one generation to the next
+        OSCILLATING = 3 # cycling through the same states, every period
+
+    def __init__(self, max_period=64, seed=0):
+        self.max_period = max_period
+        self.seed = np.uint64(seed)
+        self.clear()
+
+    def clear(self):
+        # forget everything, e.g. after the world was changed by hand
+        self.loaded = False
+        self.hash = np.uint64(0)
+        self.population = 0
+        self.outcome = History.Outcome.RUNNING
+        self.period = None
+        # the most recent hashes, oldest first, and the latest generation
+        # each was seen at
+        self.recent = deque()
+        self.seen_at = {}
+
+    def finished(self):
+        return self.outcome != History.Outcome.RUNNING
+
+    def keys(self, indices, teams):
+        # a random looking 64-bit key for each (flat index, team), made by
+        # the splitmix64 finaliser rather than looked up, so there's no table
+        # of cells * teams keys to keep. Dead cells have no key
+        with np.errstate(over="ignore"):
+            z = indices.astype(np.uint64) << np.uint64(16)
+            z |= teams.astype(np.uint64)
+            z ^= self.seed
+            z += np.uint64(0x9E3779B97F4A7C15)
+            z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            z ^= z >> np.uint64(31)
+        z[teams == 0] = 0
+        return z
+
+    def hash_of(self, indices, teams):
+        if len(indices) == 0:
+            return np.uint64(0)
+        return np.bitwise_xor.reduce(self.keys(indices, teams))
+
+    def load(self, team_grid, generation):
+        self.clear()
+        indices = np.flatnonzero(team_grid)
+        self.hash = self.hash_of(indices, team_grid.ravel()[indices])
+        self.population = len(indices)
+        self.loaded = True
+        self.check(generation, changed=True)
+        self.remember(generation)
+
+    def record(self, diff, generation):
+        # update from a Diff between the last generation recorded and this
+        # one, which may be several generations on after an advance
+        self.hash ^= self.hash_of(diff.indices, diff.old_teams)
+        self.hash ^= self.hash_of(diff.indices, diff.new_teams)
+        self.population += np.count_nonzero(diff.new_teams) \
+                           - np.count_nonzero(diff.old_teams)
+        self.check(generation, changed=len(diff) != 0)
+        self.remember(generation)
+
+    def edit(self, diff):
+        # cells changed by hand rather than by a generation passing, so the
+        # states seen before can't come round again by themselves
+        if not self.loaded:
+            return
+        self.hash ^= self.hash_of(diff.indices, diff.old_teams)
+        self.hash ^= self.hash_of(diff.indices, diff.new_teams)
+        self.population += np.count_nonzero(diff.new_teams) \
+                           - np.count_nonzero(diff.old_teams)
+        self.outcome = History.Outcome.RUNNING
+        self.period = None
+        self.recent.clear()
+        self.seen_at.clear()
+
+    def check(self, generation, changed):
+        if self.finished():
+            return
+        if self.population == 0:
+            self.outcome = History.Outcome.EXTINCT
+        elif not changed:
+            self.outcome = History.Outcome.STATIC
+            self.period = 1
+        elif self.hash in self.seen_at:
+            self.outcome = History.Outcome.OSCILLATING
+            self.period = generation - self.seen_at[self.hash]
+
+    def remember(self, generation):
+        self.recent.append((self.hash, generation))
+        self.seen_at[self.hash] = generation
+        while len(self.recent) > self.max_period:
+            old_hash, old_generation = self.recent.popleft()
+            # unless it's been seen again since
+            if self.seen_at.get(old_hash) == old_generation:
+                del self.seen_at[old_hash]
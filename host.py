@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from world import World
+from setup import Setup
+from rules import Rules
+from settings import Settings
+from server import MatchServer
+from protocol import Phase
+
+# Hosts many matches in one process, each served on its own port, e.g.:
+#   python host.py --matches 50 --size 64 64 --tick 100
+
+
+class TickStats:
+    """How promptly a match's generations have been evolved: how late each
+    tick started after it was due, how long its evolve took, and how many
+    ticks were missed altogether by falling more than a whole tick behind"""
+    def __init__(self, length=1024):
+        self.ticks = 0
+        self.missed_deadlines = 0
+        self.max_latency = 0.0
+        # the most recent latencies and evolve times, in seconds
+        self.latencies = deque(maxlen=length)
+        self.evolve_times = deque(maxlen=length)
+
+    def record(self, latency, evolve_time):
+        self.ticks += 1
+        self.max_latency = max(self.max_latency, latency)
+        self.latencies.append(latency)
+        self.evolve_times.append(evolve_time)
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000.0
+        evolve_times = np.array(self.evolve_times) * 1000.0
+        return {
+            "ticks": self.ticks,
+            "missed_deadlines": self.missed_deadlines,
+            "mean_latency_ms": float(latencies.mean()) if self.ticks else None,
+            "p95_latency_ms":
+                float(np.percentile(latencies, 95)) if self.ticks else None,
+            "max_latency_ms": self.max_latency * 1000.0,
+            "mean_evolve_ms":
+                float(evolve_times.mean()) if self.ticks else None,
+        }
+
+
+class MatchHost:
+    """Runs many matches in one process, sharing one event loop, one copy of
+    every import, and one pool of workers.
+
+    Each playing match has a deadline for its next generation, every
+    game_tick_wait milliseconds. Whenever matches are due they get one
+    generation each in turn, those with clients watching first and then the
+    longest overdue, so no match can hog the host. Small worlds are evolved
+    right away, while big ones (heavy_cells or more) are handed to the
+    worker pool so the loop stays free for the network and other matches. A
+    match that falls more than a whole tick behind skips the ticks it missed
+    rather than racing to catch up, and counts them as missed deadlines."""
+    def __init__(self, workers=None, heavy_cells=256 * 256):
+        self.heavy_cells = heavy_cells
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count(),
+                                       thread_name_prefix="evolve")
+        self.matches = []
+        self.deadlines = {}
+        self.stats = {}
+        self.wake = asyncio.Event()
+        self.running = False
+
+    async def add(self, match):
+        # start serving a MatchServer, with this host ticking it
+        match.match_host = self
+        self.matches.append(match)
+        self.stats[match] = TickStats()
+        await match.start()
+        return match
+
+    def schedule(self, match):
+        # called by matches once they're set up and ready to play
+        loop = asyncio.get_running_loop()
+        self.deadlines[match] = loop.time() + self.tick_seconds(match)
+        self.wake.set()
+
+    @staticmethod
+    def tick_seconds(match):
+        return match.settings.game_tick_wait / 1000.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.running = True
+        while self.running:
+            now = loop.time()
+            due = [match for match, deadline in self.deadlines.items()
+                   if deadline <= now and match.evolving is None]
+            if not due:
+                await self.idle(now)
+                continue
+
+            # watched matches first, then the most overdue
+            due.sort(key=lambda match: (len(match.connections) == 0,
+                                        self.deadlines[match]))
+            for match in due:
+                self.tick(match, loop)
+                # let the network (and finished heavy ticks) in between
+                await asyncio.sleep(0)
+
+    async def idle(self, now):
+        # sleep until the next match is due, or something changes
+        waiting = [deadline for match, deadline in self.deadlines.items()
+                   if match.evolving is None]
+        timeout = max(0.0, min(waiting) - now) if waiting else None
+        self.wake.clear()
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def tick(self, match, loop):
+        deadline = self.deadlines[match]
+        latency = loop.time() - deadline
+        start = perf_counter()
+        if match.world.get_team_grid().size < self.heavy_cells:
+            match.world.evolve()
+            self.ticked(match, loop, deadline, latency, start)
+        else:
+            match.evolving = loop.run_in_executor(self.pool,
+                                                  match.world.evolve)
+            match.evolving.add_done_callback(
+                lambda future: self.ticked(match, loop, deadline, latency,
+                                           start, future))
+
+    def ticked(self, match, loop, deadline, latency, start, future=None):
+        match.evolving = None
+        stats = self.stats[match]
+        stats.record(latency, perf_counter() - start)
+        if future is not None and future.exception() is not None:
+            # stop ticking a broken match, rather than the whole host
+            del self.deadlines[match]
+            self.wake.set()
+            return
+        match.publish()
+
+        if match.phase != Phase.PLAYING:
+            del self.deadlines[match]
+        else:
+            tick = self.tick_seconds(match)
+            next_deadline = deadline + tick
+            now = loop.time()
+            if next_deadline < now:
+                missed = int((now - next_deadline) // tick) + 1
+                stats.missed_deadlines += missed
+                next_deadline += missed * tick
+            self.deadlines[match] = next_deadline
+        self.wake.set()
+
+    def report(self):
+        # per match tick statistics, by the port each is served on
+        report = {}
+        for match in self.matches:
+            match_report = self.stats[match].report()
+            match_report["viewers"] = len(match.connections)
+            match_report["generation"] = match.world.generation
+            match_report["phase"] = match.phase.name
+            report[match.port] = match_report
+        return report
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    async def close(self):
+        self.stop()
+        for match in self.matches:
+            await match.close()
+        self.pool.shutdown()
+
+
+async def host_matches(count, world_size, teams, tick, seconds, workers):
+    host = MatchHost(workers=workers)
+    for _ in range(count):
+        setup = Setup.create(world_size, teams, Setup.Names.RANDOM)
+        world = World(setup, Rules.create(Rules.Name.COOPERATION),
+                      compact=True)
+        await host.add(MatchServer(world, Settings(None, tick)))
+    runner = asyncio.get_running_loop().create_task(host.run())
+    await asyncio.sleep(seconds)
+    report = host.report()
+    await host.close()
+    await runner
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Host many random matches in one process for a while, "
+                    "then report how promptly they ticked")
+    parser.add_argument("--matches", type=int, default=20)
+    parser.add_argument("--size", type=int, nargs=2, default=(64, 64),
+                        metavar=("X", "Y"))
+    parser.add_argument("--teams", type=int, default=4)
+    parser.add_argument("--tick", type=float, default=100.0,
+                        help="milliseconds between generations")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(host_matches(args.matches, tuple(args.size),
+                                      args.teams, args.tick, args.seconds,
+                                      args.workers))
+    for port, match in report.items():
+        print("port {}: {} ticks, {} missed, latency mean {:.2f}ms p95 "
+              "{:.2f}ms, evolve {:.2f}ms, {}".format(
+                  port, match["ticks"], match["missed_deadlines"],
+                  match["mean_latency_ms"] or 0.0,
+                  match["p95_latency_ms"] or 0.0,
+                  match["mean_evolve_ms"] or 0.0, match["phase"].lower()))
+
+
+if __name__ == "__main__":
+    main()
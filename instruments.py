@@ -0,0 +1,191 @@
+import json
+from bisect import bisect
+from functools import wraps
+from time import perf_counter
+
+
+class Histogram:
+    """Counts of durations in logarithmic bins, from a microsecond to ten
+    seconds in ten bins a decade, so recording one is a bisect and an add
+    however many have been recorded"""
+    edges = [10.0 ** (exponent / 10.0) for exponent in range(-60, 11)]
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect(Histogram.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        # the upper edge of the bin the percentile falls in, in seconds
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                if index == len(Histogram.edges):
+                    return self.max
+                return min(Histogram.edges[index], self.max)
+        return 0.0
+
+    def report(self):
+        if self.count == 0:
+            return {"count": 0}
+        milliseconds = [edge * 1000.0 for edge in Histogram.edges]
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000.0,
+            "p50_ms": self.percentile(50) * 1000.0,
+            "p95_ms": self.percentile(95) * 1000.0,
+            "p99_ms": self.percentile(99) * 1000.0,
+            "max_ms": self.max * 1000.0,
+            # only the bins with anything in, by the upper edge of each
+            "bins_ms": [[milliseconds[index]
+                         if index < len(milliseconds) else None, count]
+                        for index, count in enumerate(self.counts) if count],
+        }
+
+
+class Instruments:
+    """Where the time goes in a running game: how long each timed phase
+    takes, how far generations drift from game_tick_wait apart, and how many
+    frames take longer than the frame rate allows.
+
+    Everything is off until enabled, when timed() functions cost a check of
+    enabled and nothing more. Measurements are gathered over periods of
+    period seconds, and at the end of each the period's snapshot is kept for
+    an overlay and appended to path as a line of JSON, if one was given."""
+    def __init__(self, period=1.0, path=None):
+        self.enabled = False
+        self.overlay = False
+        self.period = period
+        self.path = path
+        self.phases = {}
+        self.tick_jitter = Histogram()
+        self.frame_overruns = 0
+        self.frames = 0
+        self.last_tick = None
+        self.period_start = None
+        # the latest finished period's snapshot, and how many there have been
+        self.snapshot = None
+        self.snapshots = 0
+
+    def enable(self, overlay=False):
+        self.enabled = True
+        self.overlay = overlay
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+        self.overlay = False
+        self.snapshot = None
+
+    def toggle(self):
+        # on with its overlay, or off
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable(overlay=True)
+
+    def reset(self):
+        self.phases = {}
+        self.tick_jitter = Histogram()
+        self.frame_overruns = 0
+        self.frames = 0
+        self.last_tick = None
+        self.period_start = perf_counter()
+
+    def record(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        histogram.record(seconds)
+
+    def tick(self, game_tick_wait):
+        # a generation is starting, game_tick_wait milliseconds after the last
+        # one should have
+        now = perf_counter()
+        if self.last_tick is not None and game_tick_wait > 0:
+            self.tick_jitter.record(abs(now - self.last_tick
+                                        - game_tick_wait / 1000.0))
+        self.last_tick = now
+
+    def stop_ticking(self):
+        # a gap in generations (paused, or finished) isn't jitter
+        self.last_tick = None
+
+    def frame(self, seconds, budget):
+        # a pass of the game loop is done, its work having taken seconds out
+        # of a budget of seconds per frame
+        self.frames += 1
+        self.record("frame", seconds)
+        if seconds > budget:
+            self.frame_overruns += 1
+        if perf_counter() - self.period_start >= self.period:
+            self.finish_period()
+
+    def finish_period(self):
+        self.snapshot = self.report()
+        self.snapshots += 1
+        if self.path is not None:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(self.snapshot) + "\n")
+        last_tick = self.last_tick
+        self.reset()
+        self.last_tick = last_tick
+
+    def report(self):
+        return {
+            "seconds": perf_counter() - self.period_start,
+            "frames": self.frames,
+            "frame_overruns": self.frame_overruns,
+            "tick_jitter": self.tick_jitter.report(),
+            "phases": {phase: histogram.report()
+                       for phase, histogram in sorted(self.phases.items())},
+        }
+
+    def overlay_lines(self):
+        # the latest snapshot, as short lines of text to draw over the game
+        snapshot = self.snapshot
+        if snapshot is None:
+            return ["measuring..."]
+        lines = ["{} frames, {} over budget".format(
+            snapshot["frames"], snapshot["frame_overruns"])]
+        jitter = snapshot["tick_jitter"]
+        if jitter["count"]:
+            lines.append("tick jitter {:.1f}ms p95 {:.1f}ms max".format(
+                jitter["p95_ms"], jitter["max_ms"]))
+        for phase, report in snapshot["phases"].items():
+            if report["count"]:
+                lines.append("{} {:.2f}ms mean {:.2f}ms p95 x{}".format(
+                    phase, report["mean_ms"], report["p95_ms"],
+                    report["count"]))
+        return lines
+
+
+# the instruments everything records into
+instruments = Instruments()
+
+
+def timed(phase):
+    # decorator recording every call of a function into instruments, while
+    # they're enabled
+    def decorator(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if not instruments.enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                instruments.record(phase, perf_counter() - start)
+        return timed_function
+    return decorator
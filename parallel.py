@@ -0,0 +1,86 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from rules import EvolveBuffers
+
+
+class Parallel:
+    """Evolves a compact team grid on several cores at once, by splitting it
+    into horizontal bands of rows.
+
+    Every band reads its rows plus a one row halo either side straight out of
+    the one shared padded grid, and writes into its own rows of the other, so
+    the world is never split up, copied or pickled. NumPy drops the GIL while
+    it works through arrays, so a persistent pool of threads is enough to keep
+    every core busy."""
+    def __init__(self, rules, workers=None):
+        self.rules = rules
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers,
+                                       thread_name_prefix="evolve")
+        self.buffers = None
+        self.bands = []
+        # flat indices of the cells that changed in the latest evolve
+        self.changed_cells = None
+
+    @property
+    def borders(self):
+        return self.rules.borders
+
+    @borders.setter
+    def borders(self, borders):
+        self.rules.borders = borders
+
+    def close(self):
+        self.pool.shutdown()
+
+    def evolve(self, world_array):
+        if world_array.ndim == 2:
+            return self.evolve_team_grid(world_array)
+        world_array = self.rules.evolve(world_array)
+        self.changed_cells = self.rules.changed_cells
+        return world_array
+
+    def forget(self):
+        self.rules.forget()
+
+    def evolve_padded(self, padded, out, buffers, changed=False):
+        return self.rules.evolve_padded(padded, out, buffers, changed)
+
+    def advance(self, world_array, generations):
+        for _ in range(generations):
+            world_array = self.evolve(world_array)
+        return world_array
+
+    def evolve_team_grid(self, team_grid):
+        if self.buffers is None or not self.buffers.fits(team_grid):
+            self.buffers = EvolveBuffers(team_grid.shape, team_grid.dtype)
+            self.bands = self.split(team_grid)
+        buffers = self.buffers
+        padded = buffers.load(team_grid, self.rules.borders)
+        result_team_grid = EvolveBuffers.interior(buffers.spare())
+
+        jobs = [self.pool.submit(self.rules.evolve_padded,
+                                 padded[x0:x1 + 2], result_team_grid[x0:x1],
+                                 band_buffers, True)
+                for x0, x1, band_buffers in self.bands]
+        # each band's changed cells are numbered from its first row, and the
+        # bands are in order, so the whole lot stays sorted
+        y = team_grid.shape[1]
+        # job.result() re-raises anything that went wrong in a worker
+        self.changed_cells = np.concatenate(
+            [job.result() + x0 * y
+             for job, (x0, _, _) in zip(jobs, self.bands)])
+
+        buffers.current = 1 - buffers.current
+        return result_team_grid
+
+    def split(self, team_grid):
+        # (first row, end row, scratch space) for each band, as even as
+        # possible with at least one row each
+        x, y = team_grid.shape
+        edges = np.linspace(0, x, min(self.workers, x) + 1).astype(int)
+        return [(x0, x1, EvolveBuffers((x1 - x0, y), team_grid.dtype,
+                                       double_buffered=False))
+                for x0, x1 in zip(edges[:-1], edges[1:])]
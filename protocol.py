@@ -0,0 +1,110 @@
+import struct
+import numpy as np
+from enum import Enum
+
+# Messages between match servers and clients are a kind byte and a payload
+# length, then the payload:
+#   JOIN        role                    client wants to play or spectate
+#   PLACE       x, y                    client places a cell for its team
+#   WELCOME     team, world size, teams, phase, cells each
+#   KEYFRAME    generation, the whole team grid as runs
+#   DIFF        generation, the cells that changed as runs
+#   PHASE       phase, generation
+#   ERROR       reason, as UTF-8
+# Team grids and diffs are sent as runs of consecutive cells going to the
+# same team: the gap since the end of the last run, the run's length and the
+# team, so big areas of the same team (or a handful of changes in an
+# otherwise quiet world) cost a few bytes.
+
+
+class Message(Enum):
+    JOIN = 0
+    PLACE = 1
+    WELCOME = 2
+    KEYFRAME = 3
+    DIFF = 4
+    PHASE = 5
+    ERROR = 6
+
+
+class Role(Enum):
+    PLAYER = 0
+    SPECTATOR = 1
+
+
+class Phase(Enum):
+    # the same stages as Game.State
+    SETUP = 0
+    PLAYING = 1
+    END = 2
+
+
+header_format = struct.Struct("<BI")
+join_format = struct.Struct("<B")
+place_format = struct.Struct("<II")
+welcome_format = struct.Struct("<HIIHBI")
+generation_format = struct.Struct("<Q")
+phase_format = struct.Struct("<BQ")
+
+
+def pack(kind, payload=b""):
+    return header_format.pack(kind.value, len(payload)) + payload
+
+
+async def read_message(reader):
+    # (Message, payload), raising asyncio.IncompleteReadError once the other
+    # end has gone
+    kind, length = header_format.unpack(
+        await reader.readexactly(header_format.size))
+    return Message(kind), await reader.readexactly(length)
+
+
+def encode_runs(indices, teams):
+    # sorted flat indices and the teams they go to, as runs
+    count = len(indices)
+    if count == 0:
+        return struct.pack("<I", 0)
+    indices = indices.astype(np.int64)
+    breaks = np.flatnonzero((np.diff(indices) != 1) | (np.diff(teams) != 0))
+    starts = np.concatenate(([0], breaks + 1))
+    lengths = np.diff(np.append(starts, count))
+    run_starts = indices[starts]
+    run_ends = run_starts + lengths
+    gaps = run_starts - np.concatenate(([0], run_ends[:-1]))
+    return struct.pack("<I", len(starts)) + gaps.astype("<u4").tobytes() \
+        + lengths.astype("<u4").tobytes() \
+        + teams[starts].astype("<u2").tobytes()
+
+
+def decode_runs(payload, offset=0):
+    # back to (indices, teams)
+    count, = struct.unpack_from("<I", payload, offset)
+    offset += 4
+    gaps = np.frombuffer(payload, "<u4", count, offset).astype(np.int64)
+    lengths = np.frombuffer(payload, "<u4", count,
+                            offset + 4 * count).astype(np.int64)
+    run_teams = np.frombuffer(payload, "<u2", count, offset + 8 * count)
+    run_starts = np.cumsum(gaps + lengths) - lengths
+    # each cell is as far into its run as it is past the run's first cell
+    first_cells = np.cumsum(lengths) - lengths
+    indices = np.arange(lengths.sum()) + np.repeat(run_starts - first_cells,
+                                                   lengths)
+    return indices, np.repeat(run_teams, lengths)
+
+
+def encode_grid(generation, team_grid):
+    flat = team_grid.ravel()
+    return generation_format.pack(generation) + \
+        encode_runs(np.arange(len(flat)), flat)
+
+
+def encode_diff(generation, indices, new_teams):
+    return generation_format.pack(generation) + \
+        encode_runs(indices, new_teams)
+
+
+def decode_update(payload):
+    # (generation, indices, teams) from a KEYFRAME or DIFF payload
+    generation, = generation_format.unpack_from(payload)
+    indices, teams = decode_runs(payload, generation_format.size)
+    return generation, indices, teams
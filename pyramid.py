@@ -0,0 +1,164 @@
+import numpy as np
+
+
+class Pyramid:
+    """A world's team grid at ever coarser levels of detail, for drawing it
+    zoomed out without looking at every cell.
+
+    Level k has a cell for every 2^k by 2^k block of the world, holding how
+    many live cells are in the block and the team holding most of them (as
+    near as can be told from the four blocks of the level below, which keeps
+    updating it cheap). Level 0 is the team grid itself, so isn't kept here.
+    Levels are built once on loading, then only the blocks over each
+    generation's changed cells are worked out again."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # forget everything, e.g. after the world was changed by hand
+        self.loaded = False
+        self.teams = []
+        self.counts = []
+
+    def load(self, team_grid):
+        self.shape = team_grid.shape
+        self.teams = [None]
+        self.counts = [None]
+        teams, counts = team_grid, None
+        while max(teams.shape) > 1:
+            teams, counts = Pyramid.downsample(teams, counts)
+            self.teams.append(teams)
+            self.counts.append(counts)
+        self.loaded = True
+
+    @property
+    def levels(self):
+        return len(self.teams)
+
+    def level(self, level):
+        # (teams, counts) of every block at level, which must be at least 1
+        return self.teams[level], self.counts[level]
+
+    def record(self, diff, team_grid, rebuild_ratio=0.125):
+        # bring every level up to date with team_grid, which diff led to.
+        # Levels with more than rebuild_ratio of their blocks to update are
+        # quicker to build again whole, along with every level above
+        xs, ys = diff.positions()
+        for level in range(1, self.levels):
+            if len(xs) == 0:
+                break
+            teams = self.teams[level]
+            if len(xs) > rebuild_ratio * teams.size:
+                self.rebuild(level, team_grid)
+                break
+            blocks = np.unique((xs >> 1) * teams.shape[1] + (ys >> 1))
+            xs, ys = np.divmod(blocks, teams.shape[1])
+            self.update_blocks(level, xs, ys, team_grid)
+
+    def rebuild(self, first_level, team_grid):
+        # build first_level and every level above from the one below it
+        if first_level == 1:
+            teams, counts = team_grid, None
+        else:
+            teams, counts = self.level(first_level - 1)
+        for level in range(first_level, self.levels):
+            teams, counts = Pyramid.downsample(teams, counts)
+            self.teams[level] = teams
+            self.counts[level] = counts
+
+    def update_blocks(self, level, xs, ys, team_grid):
+        # work out the blocks at (xs, ys) of level again from the four below
+        if level == 1:
+            below_teams, below_counts = team_grid, None
+        else:
+            below_teams, below_counts = self.level(level - 1)
+        below_x, below_y = below_teams.shape
+        child_teams = []
+        child_counts = []
+        for dx, dy in Pyramid.children:
+            child_xs = 2 * xs + dx
+            child_ys = 2 * ys + dy
+            # blocks past odd sides of the level below are dead
+            inside = (child_xs < below_x) & (child_ys < below_y)
+            child_xs = np.minimum(child_xs, below_x - 1)
+            child_ys = np.minimum(child_ys, below_y - 1)
+            child_teams.append(below_teams[child_xs, child_ys] * inside)
+            if below_counts is not None:
+                child_counts.append(below_counts[child_xs, child_ys] * inside)
+        if below_counts is None:
+            child_counts = None
+        teams, counts = self.level(level)
+        teams[xs, ys], counts[xs, ys] = Pyramid.majority(child_teams,
+                                                         child_counts)
+
+    # the blocks of the level below making up each block, in the order ties
+    # are settled in
+    children = ((0, 0), (1, 0), (0, 1), (1, 1))
+
+    @staticmethod
+    def downsample(teams, counts=None, rows=512):
+        # the level above (teams, counts), treating cells past odd sides as
+        # dead. counts of None means teams is a team grid, with one live cell
+        # in each of its non-zero cells. Worked out rows at a time, to not
+        # need several copies of a big world at once
+        x, y = teams.shape
+        if x % 2 or y % 2:
+            teams = Pyramid.pad_even(teams)
+            if counts is not None:
+                counts = Pyramid.pad_even(counts)
+        above_x, above_y = teams.shape[0] // 2, teams.shape[1] // 2
+        above_teams = np.empty((above_x, above_y), dtype=teams.dtype)
+        above_counts = np.empty((above_x, above_y), dtype=np.uint32)
+        for start in range(0, above_x, rows):
+            end = min(start + rows, above_x)
+            rows_below = slice(2 * start, 2 * end)
+            child_teams = [teams[rows_below][dx::2, dy::2]
+                           for dx, dy in Pyramid.children]
+            child_counts = None if counts is None else \
+                [counts[rows_below][dx::2, dy::2]
+                 for dx, dy in Pyramid.children]
+            above_teams[start:end], above_counts[start:end] = \
+                Pyramid.majority(child_teams, child_counts)
+        return above_teams, above_counts
+
+    @staticmethod
+    def pad_even(array):
+        x, y = array.shape
+        padded = np.zeros((x + x % 2, y + y % 2), dtype=array.dtype)
+        padded[:x, :y] = array
+        return padded
+
+    @staticmethod
+    def majority(child_teams, child_counts=None):
+        # for the teams of four blocks and their live cells (or of four cells
+        # of a team grid, if child_counts is None), the team with the most
+        # live cells between them, the first on a tie, and the live cells in
+        # all four. Dead blocks are always team 0, so never win a vote
+        if child_counts is None:
+            child_counts = [teams != 0 for teams in child_teams]
+            dtype = np.uint8
+        else:
+            dtype = np.uint32
+        same = {}
+        for first in range(4):
+            for second in range(first + 1, 4):
+                same[first, second] = same[second, first] = \
+                    child_teams[first] == child_teams[second]
+
+        best_teams = np.array(child_teams[0])
+        best_votes = None
+        for child in range(4):
+            votes = child_counts[child].astype(dtype)
+            for other in range(4):
+                if other != child:
+                    votes += same[child, other] * child_counts[other]
+            if best_votes is None:
+                best_votes = votes
+            else:
+                np.copyto(best_teams, child_teams[child],
+                          where=votes > best_votes)
+                np.maximum(best_votes, votes, out=best_votes)
+        total = child_counts[0].astype(np.uint32)
+        for child in range(1, 4):
+            total += child_counts[child]
+        return best_teams, total
@@ -1,50 +1,357 @@
+import numpy as np
 import pygame
-from math import floor
+from math import ceil, floor, log2
+
+from instruments import timed
 
 
 class Screen:
-    def __init__(self, res):
+    def __init__(self, res, block_fill=0.8, full_redraw_ratio=0.05):
         pygame.init()
 
         self.res = res
         self.screen = pygame.display.set_mode(res)
+        # the view of the world: pixels per cell, and the (fractional) cell
+        # at the top left corner of the screen. Zooming goes from fitting the
+        # whole world on screen to max_scaling
         self.scaling = None
+        self.origin = (0.0, 0.0)
+        self.world_size = None
+        self.fit_scaling = None
+        self.max_scaling = 64.0
+        # zoomed out past a pixel a cell, the world is drawn from its levels
+        # of detail, shading blocks by how much of them is alive
+        self.shades = 8
+        # the world is drawn onto a persistent canvas, so only the cells that
+        # change need drawing each generation. Once more than
+        # full_redraw_ratio of them have changed it's quicker to redraw it all
+        self.canvas = None
+        self.drawn = None
+        self.full_redraw_ratio = full_redraw_ratio
+        # areas of the screen to push to the display on the next flip, and
+        # things drawn over the world this frame (cursor, etc.)
+        self.full_update = True
+        self.dirty_rects = []
+        self.overlay_rects = []
+        self.reset_canvas()
+        # fraction of each cell's width taken up by its block, leaving a gap
+        # between blocks (1.0 for no gap)
+        self.block_fill = block_fill
+
+        # which cell each column and row of pixels shows, and which pixels
+        # fall in the gaps, cached until the world size, view or resolution
+        # changes
+        self.pixel_cells = None
+        self.pixel_cells_key = None
+        self.mapped_palette = None
+        self.mapped_palette_source = None
+        self.mapped_shades = None
+        self.mapped_shades_source = None
+        self.font = None
 
     def change_res(self, res, world=None):
         self.res = res
         self.screen = pygame.display.set_mode(res)
+        self.mapped_palette_source = None
+        self.mapped_shades_source = None
+        self.reset_canvas()
         if world is not None:
             self.update_scaling(world)
 
+    def reset_canvas(self):
+        self.canvas = pygame.Surface(self.res, 0, self.screen)
+        self.drawn = None
+        self.full_update = True
+        self.dirty_rects = []
+        self.overlay_rects = []
+
     def update_scaling(self, world):
         width, height = self.res
         world_width, world_height = world.setup.world_size
         try:
-            self.scaling = min((width / world_width), height / world_height)
+            self.fit_scaling = min((width / world_width),
+                                   height / world_height)
+            self.world_size = (world_width, world_height)
+            self.scaling = None
+            self.set_view((0.0, 0.0), self.fit_scaling)
         except ZeroDivisionError():
             raise RuntimeError("Attempted to update scaling using a world with"
                                " a 0 world_width or world_height. Have you"
                                "used a world without a setup size?")
 
-    def draw_block(self, pos, colour):
-        block_size = floor(self.scaling * 0.8)
+    def view(self):
+        # what's on screen, which changes whenever it's panned or zoomed
+        return self.origin, self.scaling
+
+    def set_view(self, origin, scaling):
+        # look at the world from origin at scaling, keeping as much of the
+        # world on screen as will fit
+        scaling = min(max(scaling, self.fit_scaling),
+                      max(self.max_scaling, self.fit_scaling))
+        clamped = []
+        for start, cells, pixels in zip(origin, self.world_size, self.res):
+            spare = cells - pixels / scaling
+            clamped.append(min(max(start, min(0.0, spare)), max(0.0, spare)))
+        if (tuple(clamped), scaling) != self.view():
+            self.origin = tuple(clamped)
+            self.scaling = scaling
+            self.drawn = None
+
+    def reset_view(self):
+        self.set_view((0.0, 0.0), self.fit_scaling)
+
+    def pan(self, dx, dy):
+        # move the world across the screen by (dx, dy) pixels
+        x, y = self.origin
+        self.set_view((x - dx / self.scaling, y - dy / self.scaling),
+                      self.scaling)
+
+    def zoom(self, factor, around=None):
+        # zoom in by factor (or out, if it's below 1), keeping whatever is at
+        # pixel around (the middle of the screen by default) where it is
+        if around is None:
+            around = (self.res[0] / 2, self.res[1] / 2)
+        x, y = self.world_position(around)
+        scaling = self.scaling * factor
+        self.set_view((x - around[0] / scaling, y - around[1] / scaling),
+                      scaling)
+
+    def world_position(self, pos):
+        # where in the world pixel pos is, in fractions of cells
         x, y = pos
-        x = int((x + 0.1) * self.scaling)
-        y = int((y + 0.1) * self.scaling)
+        origin_x, origin_y = self.origin
+        return origin_x + x / self.scaling, origin_y + y / self.scaling
+
+    def cell_at(self, pos):
+        # the cell at pixel pos, or None if that's off the world
+        x, y = self.world_position(pos)
+        x, y = floor(x), floor(y)
+        world_x, world_y = self.world_size
+        if 0 <= x < world_x and 0 <= y < world_y:
+            return x, y
+        return None
+
+    def pixel_position(self, pos):
+        # the pixel at the top left of world position pos
+        x, y = pos
+        origin_x, origin_y = self.origin
+        return floor((x - origin_x) * self.scaling), \
+            floor((y - origin_y) * self.scaling)
+
+    def visible_cells(self):
+        # the (start, stop) cells along each axis at least partly on screen
+        return tuple((max(0, floor(start)),
+                      min(cells, ceil(start + pixels / self.scaling)))
+                     for start, cells, pixels in zip(self.origin,
+                                                     self.world_size,
+                                                     self.res))
+
+    def detail_level(self):
+        # the level of detail with blocks of cells at least a pixel wide
+        if self.scaling >= 1.0:
+            return 0
+        return ceil(log2(1.0 / self.scaling) - 1e-9)
+
+    def block_size(self):
+        # how many pixels wide every cell's block is
+        return max(1, floor(self.scaling * self.block_fill))
+
+    def block_starts(self, cells, origin):
+        # the first pixel of the blocks of cells along one axis, viewed from
+        # origin. Every way of drawing the world lays blocks out with this
+        margin = (1.0 - self.block_fill) / 2
+        return np.floor((np.asarray(cells) + margin - origin)
+                        * self.scaling).astype(int)
+
+    def draw_block(self, pos, colour):
+        block_size = self.block_size()
+        origin_x, origin_y = self.origin
+        x = int(self.block_starts(pos[0], origin_x))
+        y = int(self.block_starts(pos[1], origin_y))
         rect = pygame.Rect(x, y, block_size, block_size)
         pygame.draw.rect(self.screen, colour, rect)
+        self.overlay_rects.append(rect)
+
+    def draw_world(self, world):
+        # draw only what changed since the world was last drawn, if the
+        # canvas still shows the version its diff starts from in this view
+        if self.drawn == (world, world.version, self.view()):
+            return
+        palette = world.team_colours.palette
+        level = self.detail_level()
+        diff = world.diff
+        drawn_changes = False
+        if level == 0 and diff is not None \
+                and self.drawn == (world, diff.from_version, self.view()):
+            drawn_changes = self.draw_team_changes(diff, palette)
+        if drawn_changes:
+            pass
+        elif level == 0:
+            self.draw_team_grid(world.get_team_grid(), palette)
+        else:
+            self.draw_level(world.level_of_detail(), level, palette)
+        self.drawn = (world, world.version, self.view())
+
+    def draw_team_grid(self, team_grid, palette):
+        # draw every cell on screen at once: look up which cell each pixel
+        # shows, then its colour, and blit the whole array of pixels onto the
+        # canvas
+        cells_x, cells_y, in_block = self.get_pixel_cells(team_grid.shape)
+        pixel_teams = team_grid.take(cells_x, axis=0).take(cells_y, axis=1)
+        np.multiply(pixel_teams, in_block, out=pixel_teams)
+        pixels = self.map_palette(palette)[pixel_teams]
+        self.draw_pixels(pixels)
+
+    def draw_level(self, pyramid, level, palette):
+        # draw the world zoomed out from blocks of cells at level, shading
+        # each block's team colour by how much of the block is alive
+        level = min(level, pyramid.levels - 1)
+        teams, counts = pyramid.level(level)
+        cells_x, cells_y, in_block = self.get_pixel_cells(self.world_size,
+                                                          level)
+        pixel_teams = teams.take(cells_x, axis=0).take(cells_y, axis=1)
+        pixel_counts = counts.take(cells_x, axis=0).take(cells_y, axis=1)
+        cells = 4 ** level
+        shades = (pixel_counts.astype(np.int64) * self.shades + cells - 1) \
+            // cells - 1
+        np.clip(shades, 0, self.shades - 1, out=shades)
+        shades += pixel_teams.astype(np.int64) * self.shades
+        np.multiply(shades, in_block, out=shades)
+        self.draw_pixels(self.map_shades(palette)[shades])
+
+    def draw_pixels(self, pixels):
+        pygame.surfarray.blit_array(self.canvas, pixels)
+        self.screen.blit(self.canvas, (0, 0))
+        self.full_update = True
+
+    def draw_team_changes(self, diff, palette):
+        # redraw just the blocks of the cells in diff that are on screen, and
+        # mark them dirty. Returns False, drawing nothing, if more than
+        # full_redraw_ratio of the cells on screen changed
+        (start_x, stop_x), (start_y, stop_y) = self.visible_cells()
+        xs, ys = diff.positions()
+        visible = (xs >= start_x) & (xs < stop_x) & \
+            (ys >= start_y) & (ys < stop_y)
+        if np.count_nonzero(visible) > self.full_redraw_ratio * \
+                (stop_x - start_x) * (stop_y - start_y):
+            return False
+
+        block_size = self.block_size()
+        origin_x, origin_y = self.origin
+        xs = self.block_starts(xs[visible], origin_x)
+        ys = self.block_starts(ys[visible], origin_y)
+        colours = self.map_palette(palette)[diff.new_teams[visible]]
+
+        rects = [pygame.Rect(x, y, block_size, block_size)
+                 for x, y in zip(xs.tolist(), ys.tolist())]
+        for rect, colour in zip(rects, colours.tolist()):
+            self.canvas.fill(colour, rect)
+        self.screen.blits([(self.canvas, rect, rect) for rect in rects],
+                          doreturn=False)
+        self.dirty_rects.extend(rects)
+        return True
+
+    def map_palette(self, palette):
+        # RGB palette to the screen's own pixel values, so colouring the
+        # pixels is a single lookup of one int each
+        if self.mapped_palette_source is not palette:
+            self.mapped_palette = np.array(
+                [self.screen.map_rgb(tuple(colour)) for colour in palette],
+                dtype=np.uint32)
+            self.mapped_palette_source = palette
+        return self.mapped_palette
+
+    def map_shades(self, palette):
+        # screen pixel values for each team (rows of self.shades) at each
+        # shade, from dim for nearly empty blocks to full for full ones
+        if self.mapped_shades_source is not palette:
+            brightness = 0.3 + 0.7 * np.arange(1, self.shades + 1) \
+                / self.shades
+            colours = np.asarray(palette, dtype=float)[:, None, :] \
+                * brightness[None, :, None]
+            self.mapped_shades = np.array(
+                [self.screen.map_rgb(tuple(colour))
+                 for colour in colours.astype(np.uint8).reshape(-1, 3)
+                 .tolist()], dtype=np.uint32)
+            self.mapped_shades_source = palette
+        return self.mapped_shades
+
+    def get_pixel_cells(self, world_size, level=0):
+        # the cells (or blocks of them, at a level of detail) shown by each
+        # column and row of pixels, and which pixels show any
+        key = (world_size, level, self.view(), self.res, self.block_fill)
+        if self.pixel_cells_key != key:
+            x_cells, x_in_block = self.map_pixels_to_cells(
+                world_size[0], self.res[0], self.origin[0], level)
+            y_cells, y_in_block = self.map_pixels_to_cells(
+                world_size[1], self.res[1], self.origin[1], level)
+            in_block = np.logical_and(x_in_block[:, None],
+                                      y_in_block[None, :])
+            self.pixel_cells = x_cells, y_cells, in_block
+            self.pixel_cells_key = key
+        return self.pixel_cells
+
+    def map_pixels_to_cells(self, cells, pixels, origin=0.0, level=0):
+        # the cell index covering each pixel along one axis, and whether the
+        # pixel shows a cell at all, rather than a gap between blocks or
+        # beyond the edge of the world. Cells are laid out by block_starts(),
+        # just as draw_block() and draw_team_changes() draw them; blocks at a
+        # level of detail fill their cells
+        if level > 0:
+            positions = origin + np.arange(pixels) / self.scaling
+            pixel_cells = np.floor(positions).astype(np.intp)
+            in_block = (pixel_cells >= 0) & (pixel_cells < cells)
+            np.clip(pixel_cells, 0, cells - 1, out=pixel_cells)
+            return pixel_cells >> level, in_block
+
+        # only the cells with blocks that could be on screen
+        first = max(0, floor(origin) - 1)
+        last = min(cells, ceil(origin + pixels / self.scaling) + 1)
+        block_cells = np.arange(first, last)
+        covered = self.block_starts(block_cells, origin)[:, None] \
+            + np.arange(self.block_size())[None, :]
+        covering_cells = np.repeat(block_cells, covered.shape[1])
+        covered = covered.ravel()
+        on_screen = (covered >= 0) & (covered < pixels)
+
+        pixel_cells = np.zeros(pixels, dtype=np.intp)
+        in_block = np.zeros(pixels, dtype=bool)
+        pixel_cells[covered[on_screen]] = covering_cells[on_screen]
+        in_block[covered[on_screen]] = True
+        return pixel_cells, in_block
 
     def draw_outline(self, pos, size, colour, thickness=1):
         x_size, y_size = size
         x_size *= self.scaling
         y_size *= self.scaling
-        x, y = pos
-        x *= self.scaling
-        y *= self.scaling
+        x, y = self.pixel_position(pos)
         rect = pygame.Rect(x, y, int(x_size), int(y_size))
         pygame.draw.rect(self.screen, colour, rect, thickness)
+        self.overlay_rects.append(rect)
+
+    def draw_text(self, lines, pos=(4, 4), colour=(255, 255, 0),
+                  background=(0, 0, 0)):
+        # lines of text over the world, one under the other
+        if self.font is None:
+            pygame.font.init()
+            self.font = pygame.font.Font(None, 20)
+        x, y = pos
+        for line in lines:
+            text = self.font.render(line, True, colour, background)
+            rect = self.screen.blit(text, (x, y))
+            self.overlay_rects.append(rect)
+            y += rect.height
 
+    @timed("flip")
     def flip(self):
-        pygame.display.update()
-        # reset screen for next draw
-        self.screen.fill(pygame.Color(0, 0, 0))
+        if self.full_update:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.dirty_rects + self.overlay_rects)
+        # put the canvas back over this frame's overlays, which the display
+        # will need to pick up on the next flip
+        for rect in self.overlay_rects:
+            self.screen.blit(self.canvas, rect, rect)
+        self.dirty_rects = self.overlay_rects
+        self.overlay_rects = []
+        self.full_update = False
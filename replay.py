@@ -0,0 +1,287 @@
+import mmap
+import numbers
+import shutil
+import struct
+import tempfile
+import zlib
+import numpy as np
+
+from rules import Rules
+from world import World
+
+# Replay files hold a whole match (or just one world, as a single keyframe):
+#   header       magic, format version, world size, teams, team grid dtype,
+#                rules, borders, keyframe interval and seed
+#   records      each a kind, generation and length, then a zlib compressed
+#                payload of either a whole team grid (a keyframe) or the
+#                cells that changed since the previous record (a diff)
+#   index        (generation, offset, kind) of every record, then a trailer
+#                giving where the index starts, written when closed
+# Files are read through mmap, so only the records needed are ever touched.
+
+
+class Replay:
+    """The header of a replay file"""
+    MAGIC = b"MPCREPLY"
+    INDEX_MAGIC = b"MPCINDEX"
+    VERSION = 1
+
+    header_format = struct.Struct("<8sHIIHBBBIq?")
+    record_format = struct.Struct("<BQI")
+    trailer_format = struct.Struct("<QQ8s")
+    index_dtype = np.dtype([("generation", "<u8"), ("offset", "<u8"),
+                            ("kind", "u1")])
+
+    KEYFRAME = 0
+    DIFF = 1
+
+    def __init__(self, world_size, teams, rules_name=Rules.Name.COOPERATION,
+                 borders=Rules.Borders.DEAD, seed=None, keyframe_interval=64):
+        self.world_size = tuple(world_size)
+        self.teams = teams
+        self.dtype = np.dtype(World.team_dtype(teams))
+        self.rules_name = rules_name
+        self.borders = borders
+        self.seed = Replay.recordable_seed(seed)
+        self.keyframe_interval = keyframe_interval
+
+    @staticmethod
+    def recordable_seed(seed):
+        # only integer seeds fit in the header. Anything else numpy takes as a
+        # seed (generators, sequences, ...) is recorded as no seed at all
+        if isinstance(seed, numbers.Integral) and not isinstance(seed, bool):
+            seed = int(seed)
+            if -2 ** 63 <= seed < 2 ** 63:
+                return seed
+        return None
+
+    def pack(self):
+        world_x, world_y = self.world_size
+        return Replay.header_format.pack(
+            Replay.MAGIC, Replay.VERSION, world_x, world_y, self.teams,
+            self.dtype.itemsize, self.rules_name.value, self.borders.value,
+            self.keyframe_interval,
+            0 if self.seed is None else self.seed, self.seed is not None)
+
+    @staticmethod
+    def unpack(data):
+        (magic, version, world_x, world_y, teams, itemsize, rules_value,
+         borders_value, keyframe_interval, seed, has_seed) = \
+            Replay.header_format.unpack_from(data)
+        if magic != Replay.MAGIC:
+            raise ValueError("Not a replay file")
+        if version != Replay.VERSION:
+            raise ValueError("Unsupported replay version {}".format(version))
+        replay = Replay((world_x, world_y), teams, Rules.Name(rules_value),
+                        Rules.Borders(borders_value),
+                        seed if has_seed else None, keyframe_interval)
+        if replay.dtype.itemsize != itemsize:
+            raise ValueError("Replay team grids don't match its teams")
+        return replay
+
+
+class ReplayWriter:
+    """Streams a match into a replay file, one generation at a time.
+
+    A keyframe is written every keyframe_interval generations, and whenever
+    the world changed other than by evolving, with only the changed cells of
+    each generation in between."""
+    def __init__(self, path, replay):
+        self.replay = replay
+        header = replay.pack()
+        self.file = open(path, "wb")
+        self.file.write(header)
+        # index entries are written out as records are, and copied after
+        # them on closing, so long matches don't build up the index in memory
+        self.index = tempfile.TemporaryFile()
+        self.index_count = 0
+        self.last_keyframe = None
+        self.last_version = None
+
+    @staticmethod
+    def for_world(path, world, rules_name=Rules.Name.COOPERATION, seed=None,
+                  keyframe_interval=64):
+        replay = Replay(world.setup.world_size, world.setup.teams, rules_name,
+                        world.borders, seed, keyframe_interval)
+        return ReplayWriter(path, replay)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, world):
+        # the world's latest generation, as a diff if it follows on from the
+        # last one recorded, otherwise as a keyframe
+        diff = world.diff
+        follows_on = diff is not None and self.last_version is not None \
+            and diff.from_version == self.last_version
+        due = self.last_keyframe is None or \
+            world.generation - self.last_keyframe >= \
+            self.replay.keyframe_interval
+        if follows_on and not due:
+            self.write_diff(world.generation, diff.indices, diff.new_teams)
+        else:
+            self.write_keyframe(world.generation, world.get_team_grid())
+        self.last_version = world.version
+
+    def write_keyframe(self, generation, team_grid):
+        team_grid = np.ascontiguousarray(team_grid, dtype=self.replay.dtype)
+        self.write_record(Replay.KEYFRAME, generation, team_grid.tobytes())
+        self.last_keyframe = generation
+
+    def write_diff(self, generation, indices, new_teams):
+        # sorted flat indices compress far better as gaps between them
+        gaps = np.diff(indices, prepend=0).astype("<u4")
+        new_teams = new_teams.astype(self.replay.dtype.newbyteorder("<"))
+        payload = struct.pack("<I", len(indices)) + gaps.tobytes() \
+            + new_teams.tobytes()
+        self.write_record(Replay.DIFF, generation, payload)
+
+    def write_record(self, kind, generation, payload):
+        payload = zlib.compress(payload, 1)
+        entry = np.array([(generation, self.file.tell(), kind)],
+                         dtype=Replay.index_dtype)
+        self.index.write(entry.tobytes())
+        self.index_count += 1
+        self.file.write(Replay.record_format.pack(kind, generation,
+                                                  len(payload)))
+        self.file.write(payload)
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.index.seek(0)
+        shutil.copyfileobj(self.index, self.file)
+        self.index.close()
+        self.file.write(Replay.trailer_format.pack(
+            index_offset, self.index_count, Replay.INDEX_MAGIC))
+        self.file.close()
+
+
+class ReplayReader:
+    """Reads team grids back out of a replay file for any generation.
+
+    The file is memory mapped, and seeking decompresses the nearest keyframe
+    at or before the generation and replays the diffs after it, so a read
+    costs at most keyframe_interval records however long the match is."""
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.replay = Replay.unpack(self.map)
+        self.index = self.read_index()
+        self.generations = self.index["generation"]
+        self.keyframes = np.flatnonzero(self.index["kind"] == Replay.KEYFRAME)
+        if len(self.index) != 0 and self.index["kind"][0] != Replay.KEYFRAME:
+            raise ValueError("Replay doesn't start with a keyframe")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        # any index still viewing the map has to go before it can close
+        self.index = self.generations = None
+        self.map.close()
+        self.file.close()
+
+    def read_index(self):
+        trailer_size = Replay.trailer_format.size
+        if len(self.map) >= Replay.header_format.size + trailer_size:
+            index_offset, count, magic = Replay.trailer_format.unpack_from(
+                self.map, len(self.map) - trailer_size)
+            if magic == Replay.INDEX_MAGIC:
+                return np.frombuffer(self.map, dtype=Replay.index_dtype,
+                                     count=count, offset=index_offset)
+        # never closed (e.g. the match crashed), so find the records by
+        # walking through them
+        return self.scan()
+
+    def scan(self):
+        index = []
+        offset = Replay.header_format.size
+        record_size = Replay.record_format.size
+        while offset + record_size <= len(self.map):
+            kind, generation, length = Replay.record_format.unpack_from(
+                self.map, offset)
+            if offset + record_size + length > len(self.map):
+                # cut off part way through
+                break
+            index.append((generation, offset, kind))
+            offset += record_size + length
+        return np.array(index, dtype=Replay.index_dtype)
+
+    def first_generation(self):
+        return int(self.generations[0])
+
+    def last_generation(self):
+        return int(self.generations[-1])
+
+    def payload(self, record):
+        offset = int(self.index["offset"][record])
+        _, _, length = Replay.record_format.unpack_from(self.map, offset)
+        start = offset + Replay.record_format.size
+        return zlib.decompress(self.map[start:start + length])
+
+    def apply(self, team_grid, record):
+        # bring team_grid up to the given record in place
+        payload = self.payload(record)
+        if self.index["kind"][record] == Replay.KEYFRAME:
+            team_grid.ravel()[:] = np.frombuffer(
+                payload, dtype=self.replay.dtype.newbyteorder("<"))
+            return
+        count, = struct.unpack_from("<I", payload)
+        gaps = np.frombuffer(payload, dtype="<u4", count=count, offset=4)
+        new_teams = np.frombuffer(payload,
+                                  dtype=self.replay.dtype.newbyteorder("<"),
+                                  count=count, offset=4 + 4 * count)
+        team_grid.ravel()[np.cumsum(gaps, dtype=np.int64)] = new_teams
+
+    def record_at(self, generation):
+        # the last record at or before generation
+        record = np.searchsorted(self.generations, generation, side="right")
+        if record == 0:
+            raise IndexError("Generation {} is before the replay starts"
+                             .format(generation))
+        return int(record) - 1
+
+    def team_grid(self, generation):
+        # the world as it was at generation (or the last generation recorded
+        # before it, after jumps)
+        record = self.record_at(generation)
+        keyframe = self.keyframes[np.searchsorted(self.keyframes, record,
+                                                  side="right") - 1]
+        team_grid = np.zeros(self.replay.world_size, dtype=self.replay.dtype)
+        for r in range(keyframe, record + 1):
+            self.apply(team_grid, r)
+        return team_grid
+
+    def team_grids(self, start=None, stop=None):
+        # (generation, team grid) for every record from start up to but not
+        # including stop, replaying diffs in order rather than seeking to
+        # each. The same array is updated and yielded each time
+        start = self.first_generation() if start is None else start
+        first = self.record_at(start)
+        end = len(self.index) if stop is None else \
+            int(np.searchsorted(self.generations, stop, side="left"))
+        if first >= end:
+            return
+        team_grid = self.team_grid(int(self.generations[first]))
+        yield int(self.generations[first]), team_grid
+        for record in range(first + 1, end):
+            self.apply(team_grid, record)
+            yield int(self.generations[record]), team_grid
+
+
+def save_world(path, world, rules_name=Rules.Name.COOPERATION, seed=None):
+    # a replay of just the world as it is now
+    with ReplayWriter.for_world(path, world, rules_name, seed) as writer:
+        writer.write_keyframe(world.generation, world.get_team_grid())
+
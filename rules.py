@@ -1,97 +1,501 @@
 import numpy as np
 from enum import Enum
-from astropy import convolution
 
 from world import World
 
-# TODO: Bring across other rulesets
-
 
 class Rules:
-    """The possible sets of rules for evolving the world"""
+    """The possible sets of rules for evolving the world.
+
+    Each ruleset is declared as data (which neighbours count, the counts live
+    cells survive and dead cells are born with, and what happens to cells
+    outnumbered by enemies), which is compiled into lookup tables once so that
+    every ruleset shares the same evolve core."""
     class Name(Enum):
         IGNORANCE = 0
         COOPERATION = 1
         VIOLENCE = 2
         WRETCHED_VIOLENCE = 3
 
-    # TODO: Add borders variable to set whether field is square or toroidal
+    class Borders(Enum):
+        DEAD = 0        # everything beyond the edge is dead
+        TOROIDAL = 1    # edges wrap around to the opposite side
+        REFLECTIVE = 2  # edge cells are mirrored beyond the edge
+
+    class Engine(Enum):
+        DENSE = 0       # evolve every cell, one generation at a time
+        HASHLIFE = 1    # memoized quadtree, for jumping many generations
+        PARALLEL = 2    # dense, split into bands across several cores
+
+    class Counting(Enum):
+        ALL = 0         # every live neighbour counts, whatever its team
+        OWN = 1         # only neighbours in a cell's own team count
+
+    class Outnumbered(Enum):
+        IGNORE = 0      # enemy neighbours make no difference
+        DIE = 1         # cells with more enemy neighbours than friends die
+        CONVERT = 2     # ...or are converted to the biggest enemy team
+
+    # what happens to a live cell, in the compiled survival table
+    DIES, SURVIVES, CONVERTED = 0, 1, 2
+
+    # the ruleset, declared by each inherited rules class
+    counting = Counting.ALL
+    survival = {2, 3}
+    birth = {3}
+    # with Counting.ALL, how many of a newborn's neighbours must be in its
+    # team (with Counting.OWN, the team's own count has to be in birth)
+    birth_majority = 2
+    outnumbered = Outnumbered.IGNORE
+
+    def __init__(self, borders=Borders.DEAD):
+        self.borders = borders
+        self.buffers = None
+        # flat indices of the cells that changed in the latest evolve
+        self.changed_cells = None
+        self.compile()
 
     # factory for inherited rules classes
     @staticmethod
-    def create(rules_name=Name.COOPERATION):
-        if rules_name == Rules.Name.COOPERATION:
-            return RulesCooperation()
+    def create(rules_name=Name.COOPERATION, borders=Borders.DEAD,
+               engine=Engine.DENSE, workers=None):
+        rules_classes = {
+            Rules.Name.IGNORANCE: RulesIgnorance,
+            Rules.Name.COOPERATION: RulesCooperation,
+            Rules.Name.VIOLENCE: RulesViolence,
+            Rules.Name.WRETCHED_VIOLENCE: RulesWretchedViolence,
+        }
+        rules = rules_classes[rules_name](borders=borders)
+
+        if engine == Rules.Engine.HASHLIFE:
+            from hashlife import Hashlife
+            return Hashlife(rules)
+        elif engine == Rules.Engine.PARALLEL:
+            from parallel import Parallel
+            return Parallel(rules, workers=workers)
+        return rules
+
+    def compile(self):
+        # lookup tables from the declared ruleset. For live cells, what
+        # happens to them indexed by own * 9 + total neighbours, and for dead
+        # cells, whether they're born indexed by total * 9 + the count of the
+        # biggest team around them
+        survival = np.zeros((9, 9), dtype=np.uint8)
+        births = np.zeros((9, 9), dtype=bool)
+        for total in range(9):
+            for own in range(9):
+                # impossible with own > total, but filled in as if there were
+                # no enemies so they don't look like a dependence on own
+                enemies = max(total - own, 0)
+                if self.counting == Rules.Counting.ALL:
+                    count = total
+                else:
+                    count = min(own, total)
+                if count not in self.survival:
+                    action = Rules.DIES
+                elif enemies > own and \
+                        self.outnumbered == Rules.Outnumbered.DIE:
+                    action = Rules.DIES
+                elif enemies > own and \
+                        self.outnumbered == Rules.Outnumbered.CONVERT:
+                    action = Rules.CONVERTED
+                else:
+                    action = Rules.SURVIVES
+                survival[own, total] = action
+
+            for best in range(1, total + 1):
+                if self.counting == Rules.Counting.ALL:
+                    births[total, best] = total in self.birth \
+                                          and best >= self.birth_majority
+                else:
+                    births[total, best] = best in self.birth
+
+        self.survival_table = survival.ravel()
+        self.birth_table = births.ravel()
+        # with Counting.OWN, the neighbour counts a team can breed with, so
+        # only teams that can breed compete for a dead cell
+        self.breeding_counts = None
+        if self.counting == Rules.Counting.OWN:
+            self.breeding_counts = np.isin(np.arange(9), list(self.birth))
+        self.birth_totals = births.any(axis=1)
+        # only worth counting each cell's own team if it makes a difference
+        self.survival_uses_own = not (survival == survival[0]).all()
+        self.converts = bool((survival == Rules.CONVERTED).any())
+        # births needing at least 2 of exactly 3 neighbours can't be tied, so
+        # the much cheaper majority_of_three can choose the team
+        majority_of_three = np.zeros((9, 9), dtype=bool)
+        majority_of_three[3, 2:4] = True
+        self.births_by_majority_of_three = \
+            bool((births == majority_of_three).all())
+        # most rulesets survive and are born on a run of totals, which a
+        # single comparison checks much quicker than a table lookup
+        self.survival_range = None
+        if not self.survival_uses_own and not self.converts:
+            self.survival_range = Rules.run_of(
+                np.flatnonzero(survival[0] == Rules.SURVIVES))
+        self.birth_range = Rules.run_of(np.flatnonzero(self.birth_totals))
+
+    @staticmethod
+    def run_of(values):
+        # (first, last) if the sorted values are one unbroken run, else None
+        if len(values) == 0 or values[-1] - values[0] != len(values) - 1:
+            return None
+        return int(values[0]), int(values[-1])
+
+    @staticmethod
+    def within(values, run, out, scratch):
+        # whether each uint8 value is in the (first, last) run, relying on
+        # values below first wrapping round to large ones
+        first, last = run
+        np.subtract(values, first, out=scratch)
+        return np.less_equal(scratch, last - first, out=out)
 
     def evolve(self, world_array):
+        if world_array.ndim == 2:
+            return self.evolve_team_grid(world_array)
+        # one-hot (x, y, teams) arrays go through the same core, keeping the
+        # same number of team planes even if some teams die out
+        teams = world_array.shape[2]
+        team_grid = World.team_grid_from_world_array(world_array)
+        result_team_grid = self.evolve_team_grid(
+            team_grid.astype(World.team_dtype(teams)))
+        return World.world_array_from_team_grid(result_team_grid, teams)
+
+    def evolve_team_grid(self, team_grid):
+        """Evolve a compact (x, y) grid of team ids by one generation.
+
+        The result is a view into buffers owned by these rules, so it is only
+        valid until the generation after it has been evolved, and a Rules
+        object can only evolve one world (World checks this)."""
+        if self.buffers is None or not self.buffers.fits(team_grid):
+            self.buffers = EvolveBuffers(team_grid.shape, team_grid.dtype)
+        buffers = self.buffers
+        padded = buffers.load(team_grid, self.borders)
+        result_padded = buffers.spare()
+        result_team_grid = EvolveBuffers.interior(result_padded)
+        self.changed_cells = self.evolve_padded(padded, result_team_grid,
+                                                buffers, changed=True)
+        buffers.current = 1 - buffers.current
+        return result_team_grid
+
+    def forget(self):
+        # the last grid returned was changed in place by something other than
+        # evolving. Every generation is worked out from the grid as it is now,
+        # so there's nothing to forget
         pass
 
+    def evolve_padded(self, padded, out, buffers, changed=False):
+        # padded is a (..., x + 2, y + 2) team grid whose one cell border
+        # holds whatever lies beyond the edges, out is the (..., x, y) grid to
+        # write the next generation into. If changed, returns the sorted flat
+        # indices into out of the cells that changed, from the deaths and
+        # births worked out along the way
+        team_grid = EvolveBuffers.interior(padded)
+        neighbours = Rules.count_neighbours(padded, buffers)
+
+        # what happens to every cell as if it were alive. Dead cells are
+        # team 0, so stay dead here whatever their action
+        actions = buffers.actions
+        survives = buffers.mask
+        if self.survival_range is not None:
+            Rules.within(neighbours, self.survival_range, survives, actions)
+        else:
+            if self.survival_uses_own:
+                own = Rules.count_own_team(padded, buffers)
+                np.multiply(own, 9, out=actions)
+                np.add(actions, neighbours, out=actions)
+            else:
+                actions[...] = neighbours
+            self.survival_table.take(actions, out=actions)
+            np.equal(actions, Rules.SURVIVES, out=survives)
+        np.multiply(team_grid, survives, out=out)
+        if changed:
+            # live cells not surviving as they are, which includes any
+            # converted below
+            np.greater(team_grid, out, out=buffers.other_mask)
+            died = np.flatnonzero(buffers.other_mask)
+        born_cells = np.zeros(0, dtype=np.intp)
+
+        if self.converts:
+            converted = buffers.mask
+            np.equal(actions, Rules.CONVERTED, out=converted)
+            np.not_equal(team_grid, 0, out=buffers.other_mask)
+            np.logical_and(converted, buffers.other_mask, out=converted)
+            cells = np.flatnonzero(converted)
+            if len(cells) != 0:
+                positions = np.unravel_index(cells, out.shape)
+                teams, _, unique = Rules.dominant_neighbours(
+                    padded, cells, out.shape, exclude=team_grid[positions])
+                # cells caught between equally big enemy teams die
+                out[positions] = np.where(unique, teams, 0)
+
+        born = buffers.mask
+        if self.birth_range is not None:
+            Rules.within(neighbours, self.birth_range, born, buffers.actions)
+        else:
+            self.birth_totals.take(neighbours, out=born)
+        np.equal(team_grid, 0, out=buffers.other_mask)
+        np.logical_and(born, buffers.other_mask, out=born)
+        cells = np.flatnonzero(born)
+        if len(cells) != 0:
+            positions = np.unravel_index(cells, out.shape)
+            if self.births_by_majority_of_three:
+                out[positions] = Rules.majority_of_three(padded, cells,
+                                                         out.shape)
+            else:
+                teams, best, unique = Rules.dominant_neighbours(
+                    padded, cells, out.shape,
+                    counted=self.breeding_counts)
+                totals = neighbours[positions].astype(np.intp)
+                born_here = self.birth_table[totals * 9 + best]
+                out[positions] = np.where(born_here & unique, teams, 0)
+            if changed:
+                born_cells = cells[out[positions] != 0]
+        if changed:
+            return np.sort(np.concatenate((died, born_cells)))
+        return None
+
+    def advance(self, world_array, generations):
+        for _ in range(generations):
+            world_array = self.evolve(world_array)
+        return world_array
+
     @staticmethod
-    def get_neighbours_array(world_array):
-        # TODO: REFACTOR so take a World object or at least a number of teams
-        neighbours_array = np.zeros(world_array.shape, dtype=int)
+    def count_neighbours(padded, buffers):
+        # total 8-neighbour count of live cells (any team) for the interior of
+        # a padded team grid, as a separable 3x3 box sum minus the centre
+        occupied = buffers.occupied
+        np.not_equal(padded, 0, out=occupied.view(bool))
+        return Rules.sum_neighbours(occupied, buffers.row_sums,
+                                    buffers.neighbours)
+
+    @staticmethod
+    def count_own_team(padded, buffers):
+        # number of each cell's neighbours that are in the same team as it
+        team_grid = EvolveBuffers.interior(padded)
+        x, y = team_grid.shape[-2:]
+        own = buffers.own_neighbours
+        own.fill(0)
+        same = buffers.other_mask
+        for dx in (0, 1, 2):
+            for dy in (0, 1, 2):
+                if dx == 1 and dy == 1:
+                    continue
+                np.equal(padded[..., dx:dx + x, dy:dy + y], team_grid,
+                         out=same)
+                np.add(own, same, out=own)
+        return own
+
+    @staticmethod
+    def fill_halo(padded, borders):
+        # set the one cell border around a (..., x + 2, y + 2) array in place
+        # from its interior, so that wrapping or reflecting costs only the
+        # perimeter rather than a padded copy of the whole grid
+        if borders == Rules.Borders.TOROIDAL:
+            padded[..., 0, 1:-1] = padded[..., -2, 1:-1]
+            padded[..., -1, 1:-1] = padded[..., 1, 1:-1]
+            # columns after rows, so the corners pick up the wrapped rows
+            padded[..., :, 0] = padded[..., :, -2]
+            padded[..., :, -1] = padded[..., :, 1]
+        elif borders == Rules.Borders.REFLECTIVE:
+            padded[..., 0, 1:-1] = padded[..., 1, 1:-1]
+            padded[..., -1, 1:-1] = padded[..., -2, 1:-1]
+            padded[..., :, 0] = padded[..., :, 1]
+            padded[..., :, -1] = padded[..., :, -2]
+        else:
+            padded[..., 0, :] = 0
+            padded[..., -1, :] = 0
+            padded[..., :, 0] = 0
+            padded[..., :, -1] = 0
+        return padded
+
+    @staticmethod
+    def sum_neighbours(occupied, row_sums, out):
+        # occupied is a (..., x + 2, y + 2) array of 0/1, row_sums a
+        # (..., x + 2, y) and out a (..., x, y) array to work in. Counts are at
+        # most 8, so all of this can be done in uint8
+        np.add(occupied[..., :, :-2], occupied[..., :, 1:-1], out=row_sums)
+        np.add(row_sums, occupied[..., :, 2:], out=row_sums)
 
-        kernel = np.ones((3, 3), dtype=int)
-        kernel[1][1] = 0
+        np.add(row_sums[..., :-2, :], row_sums[..., 1:-1, :], out=out)
+        np.add(out, row_sums[..., 2:, :], out=out)
+        np.subtract(out, occupied[..., 1:-1, 1:-1], out=out)
+        return out
 
-        _, _, teams = world_array.shape
-        for t in range(teams):
-            neighbours_array[:, :, t] = \
-                (8 * convolution.convolve(world_array[:, :, t], kernel,
-                                          fill_value=0))
+    @staticmethod
+    def padded_indices(cells, shape):
+        # flat indices into a padded (..., x + 2, y + 2) grid, for the given
+        # flat indices into its (..., x, y) interior
+        *lead, x, y = shape
+        rows = cells // y
+        grids = cells // (x * y)
+        return cells + 2 * rows + (y + 3) + grids * (2 * y + 4)
+
+    @staticmethod
+    def neighbour_offsets(shape):
+        # flat offsets from a cell to each of its 8 neighbours in the padded
+        # version of a grid of shape
+        row = shape[-1] + 2
+        return (-row - 1, -row, -row + 1, -1, 1, row - 1, row, row + 1)
+
+    @staticmethod
+    def dominant_neighbours(padded, cells, shape, exclude=None,
+                            counted=None):
+        # for the given interior cells (flat indices into a grid of shape),
+        # the team with the most neighbours around each, how many it has, and
+        # whether it's the only team with that many. Teams in exclude (one
+        # per cell) are ignored, as are teams whose number of neighbours
+        # isn't True in counted (indexed by count), if given
+        padded = np.ascontiguousarray(padded).ravel()
+        centres = Rules.padded_indices(cells, shape)
+        no_team = np.iinfo(padded.dtype).max
+
+        teams = np.empty((8, len(cells)), dtype=padded.dtype)
+        for i, offset in enumerate(Rules.neighbour_offsets(shape)):
+            padded.take(centres + offset, out=teams[i])
+        if exclude is not None:
+            teams[teams == exclude] = 0
+
+        # how many of the 8 neighbours share each neighbour's team
+        counts = np.zeros(teams.shape, dtype=np.uint8)
+        for i in range(8):
+            counts += teams == teams[i]
+        counts[teams == 0] = 0
+        if counted is not None:
+            counts[~counted[counts]] = 0
+
+        best = counts.max(axis=0)
+        at_best = counts == best
+        best_team = np.where(at_best, teams, 0).max(axis=0)
+        unique = best_team == np.where(at_best, teams, no_team).min(axis=0)
+        return best_team, best, unique
+
+    @staticmethod
+    def majority_of_three(padded, cells, shape):
+        # for the given interior cells (flat indices into a grid of shape),
+        # each with exactly 3 live neighbours, the team holding at least 2 of
+        # them, or 0 if all three are from different teams. With the three
+        # live neighbours low <= middle <= high, middle matches any pair
+        padded = np.ascontiguousarray(padded).ravel()
+        centres = Rules.padded_indices(cells, shape)
+        no_team = np.iinfo(padded.dtype).max
+
+        total = np.zeros(len(cells), dtype=np.int64)
+        high = np.zeros(len(cells), dtype=padded.dtype)
+        low = np.full(len(cells), no_team, dtype=padded.dtype)
+        for offset in Rules.neighbour_offsets(shape):
+            teams = padded.take(centres + offset)
+            total += teams
+            np.maximum(high, teams, out=high)
+            teams[teams == 0] = no_team
+            np.minimum(low, teams, out=low)
+
+        middle = total - low - high
+        has_majority = np.logical_or(low == middle, middle == high)
+        return np.where(has_majority, middle, 0)
+
+    @staticmethod
+    def get_neighbours_array(world_array, borders=Borders.DEAD):
+        # TODO: REFACTOR so take a World object or at least a number of teams
+        # counts for every team at once, with the team planes moved to the
+        # front so they are summed like a stack of separate grids
+        x, y, teams = world_array.shape
+        occupied = np.zeros((teams, x + 2, y + 2), dtype=np.uint8)
+        occupied[:, 1:-1, 1:-1] = np.moveaxis(world_array, 2, 0)
+        Rules.fill_halo(occupied, borders)
+        row_sums = np.empty((teams, x + 2, y), dtype=np.uint8)
+        neighbours = np.empty((teams, x, y), dtype=np.uint8)
+        Rules.sum_neighbours(occupied, row_sums, neighbours)
+
+        neighbours_array = np.empty(world_array.shape, dtype=int)
+        neighbours_array[...] = np.moveaxis(neighbours, 0, 2)
         return neighbours_array
 
 
+class EvolveBuffers:
+    """Preallocated scratch space for evolving compact team grids in place.
+
+    Two team grids with a one cell halo are kept and used alternately, so an
+    evolve reads from one and writes into the interior of the other without
+    allocating any full size temporaries."""
+    def __init__(self, shape, dtype, double_buffered=True):
+        *lead, x, y = shape
+        lead = tuple(lead)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        # scratch space for a part of a bigger grid doesn't need grids of its
+        # own to evolve between
+        if double_buffered:
+            self.padded = [np.zeros(lead + (x + 2, y + 2), dtype=dtype),
+                           np.zeros(lead + (x + 2, y + 2), dtype=dtype)]
+        else:
+            self.padded = []
+        self.current = 0
+
+        self.occupied = np.zeros(lead + (x + 2, y + 2), dtype=np.uint8)
+        self.row_sums = np.zeros(lead + (x + 2, y), dtype=np.uint8)
+        self.neighbours = np.zeros(self.shape, dtype=np.uint8)
+        self.own_neighbours = np.zeros(self.shape, dtype=np.uint8)
+        self.actions = np.zeros(self.shape, dtype=np.uint8)
+        self.mask = np.zeros(self.shape, dtype=bool)
+        self.other_mask = np.zeros(self.shape, dtype=bool)
+
+    def fits(self, team_grid):
+        return team_grid.shape == self.shape and team_grid.dtype == self.dtype
+
+    @staticmethod
+    def interior(padded):
+        return padded[..., 1:-1, 1:-1]
+
+    def load(self, team_grid, borders):
+        # returns the padded grid holding team_grid, copying it in only if it
+        # isn't already the interior of one of our buffers, with its halo
+        # filled for the given border mode
+        for i, padded in enumerate(self.padded):
+            if team_grid.base is padded:
+                self.current = i
+                break
+        else:
+            padded = self.padded[self.current]
+            self.interior(padded)[...] = team_grid
+        return Rules.fill_halo(padded, borders)
+
+    def spare(self):
+        return self.padded[1 - self.current]
+
+
+class RulesIgnorance(Rules):
+    """Teams ignore each other entirely, each living and breeding as in
+    Conway's Game of Life with only its own team's neighbours counted"""
+    counting = Rules.Counting.OWN
+    survival = {2, 3}
+    birth = {3}
+
+
 class RulesCooperation(Rules):
-    def evolve(self, world_array):
-        # TODO: REFACTOR to take a World object (or at least also take a
-        #  number of teams, as after some turns a number of teams are likely to
-        #  disappear, causing Exceptions when get_neighbouts_array and
-        #  world_array_from_team_grid are called.
-        # 3d array, showing count of each team neighbouring for each cell
-        neighbours_array = self.get_neighbours_array(world_array)
-
-        # 2d array, showing number of neighbours (all teams) for each cell
-        total_neighbours_array = np.sum(neighbours_array, axis=2)
-
-        # 2d array, showing which team is the largest neighbour (if equal, the
-        # first of the locally biggest teams - this won't matter as only used
-        # if there is an actually dominant team
-        biggest_neighbour_array\
-            = np.where(total_neighbours_array != 0,
-                       np.argmax(neighbours_array, axis=2) + 1,
-                       0*total_neighbours_array)
-
-        # 2d array, showing how many neighbours are in the dominant
-        # neighbouring team
-        num_in_biggest_neighbour_array\
-            = np.where(biggest_neighbour_array != 0,
-                       np.max(neighbours_array, axis=2),
-                       0*biggest_neighbour_array)
-
-        # 2d array, showing the reproductively successful team for each cell,
-        # if any. Reproductively successful in this ruleset is
-        # (total_neighbours == 3 and one of teams' neighbour count >= 2), if
-        # none shows zero
-        reproducing_team_array = np.where(
-            np.logical_and(
-                np.equal(total_neighbours_array, 3),
-                np.greater_equal(num_in_biggest_neighbour_array, 2)),
-            biggest_neighbour_array,
-            0*biggest_neighbour_array)
-
-        world_team_grid = World.team_grid_from_world_array(world_array)
-        # if under/overpopulated leave/set dead, else leave in current state
-        result_team_grid = np.where(
-            np.logical_or(np.less(total_neighbours_array, 2),
-                          np.greater(total_neighbours_array, 3)),
-            0 * world_team_grid,
-            world_team_grid)
-
-        # if was previously dead (0) and tot neighbours == 3, become alive
-        result_team_grid += np.where(world_team_grid == 0,
-                                    reproducing_team_array,
-                                    0*world_team_grid)
-        result_world_array = World.world_array_from_team_grid(result_team_grid)
-
-        return result_world_array
+    """Every neighbour helps a cell survive, whatever its team. Newborns join
+    the team holding at least 2 of their 3 neighbours"""
+    counting = Rules.Counting.ALL
+    survival = {2, 3}
+    birth = {3}
+    birth_majority = 2
+
+
+class RulesViolence(Rules):
+    """As cooperation, but cells with more enemy neighbours than friendly ones
+    are killed"""
+    counting = Rules.Counting.ALL
+    survival = {2, 3}
+    birth = {3}
+    birth_majority = 2
+    outnumbered = Rules.Outnumbered.DIE
+
+
+class RulesWretchedViolence(Rules):
+    """As violence, but outnumbered cells that would otherwise have survived
+    are converted to the biggest enemy team around them instead"""
+    counting = Rules.Counting.ALL
+    survival = {2, 3}
+    birth = {3}
+    birth_majority = 2
+    outnumbered = Rules.Outnumbered.CONVERT
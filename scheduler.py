@@ -0,0 +1,88 @@
+from time import sleep, monotonic
+
+from instruments import instruments
+
+
+class Scheduler:
+    """Runs a game's loop, evolving the world on a fixed timestep and
+    rendering at a separately capped frame rate.
+
+    Generations are stepped whenever a whole game_tick_wait has built up,
+    catching up after a slow frame but never more than max_steps_per_frame at
+    once (beyond that, the backlog is dropped rather than letting the game
+    fall ever further behind). Between frames the loop sleeps until the next
+    tick or frame is due, instead of spinning."""
+    def __init__(self, settings, max_steps_per_frame=5):
+        self.settings = settings
+        self.max_steps_per_frame = max_steps_per_frame
+        self.running = False
+
+        # how far the simulation has fallen behind, in milliseconds
+        self.lag = 0.0
+        self.dropped_steps = 0
+
+    def tick_seconds(self):
+        return self.settings.game_tick_wait / 1000.0
+
+    def frame_seconds(self):
+        return 1.0 / self.settings.max_fps
+
+    def run(self, game):
+        self.running = True
+        previous = monotonic()
+        next_frame = previous
+        while self.running and not game.quit:
+            now = monotonic()
+            elapsed, previous = now - previous, now
+
+            game.get_inputs()
+            game.update()
+            self.step(game, elapsed)
+
+            if now >= next_frame:
+                if game.needs_render():
+                    game.render()
+                next_frame = now + self.frame_seconds()
+
+            if instruments.enabled:
+                instruments.frame(monotonic() - now, self.frame_seconds())
+            self.idle(game, now, next_frame)
+
+    def stop(self):
+        self.running = False
+
+    def step(self, game, elapsed):
+        if not game.is_ticking():
+            # nothing to catch up on while setting up, paused, or finished
+            self.lag = 0.0
+            instruments.stop_ticking()
+            return
+
+        self.lag += elapsed * 1000.0
+        if self.settings.game_tick_wait <= 0:
+            # as fast as possible
+            for _ in range(self.max_steps_per_frame):
+                game.tick()
+            return
+
+        steps = 0
+        while self.lag >= self.settings.game_tick_wait \
+                and steps < self.max_steps_per_frame:
+            game.tick()
+            self.lag -= self.settings.game_tick_wait
+            steps += 1
+
+        if self.lag >= self.settings.game_tick_wait:
+            dropped = int(self.lag // self.settings.game_tick_wait)
+            self.dropped_steps += dropped
+            self.lag -= dropped * self.settings.game_tick_wait
+
+    def idle(self, game, frame_start, next_frame):
+        # sleep until the next frame or generation is due, whichever is first
+        wake = next_frame
+        if game.is_ticking():
+            until_tick = (self.settings.game_tick_wait - self.lag) / 1000.0
+            wake = min(wake, frame_start + until_tick)
+        now = monotonic()
+        if wake > now:
+            sleep(wake - now)
@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import numpy as np
+
+from world import World
+from setup import Setup
+from rules import Rules
+from settings import Settings
+from protocol import Message, Role, Phase, pack, read_message, \
+    encode_grid, encode_diff, join_format, place_format, welcome_format, \
+    phase_format
+
+# Runs a match for remote players and spectators, e.g.:
+#   python server.py --port 7777 --size 50 50 --teams 4 --cells-each 30
+
+
+class Connection:
+    """A client connected to a match, playing as team (0 for spectators)"""
+    def __init__(self, reader, writer, team):
+        self.reader = reader
+        self.writer = writer
+        self.team = team
+        # set when updates had to be skipped, so it's sent the whole world
+        # once it has caught up
+        self.needs_keyframe = False
+
+
+class MatchServer:
+    """The authority on one match's world, served over TCP.
+
+    Players join and are given the next free team, then place their cells
+    during setup (with each team allowed setup.num_cells_each of them). Once
+    set up, the world evolves every settings.game_tick_wait milliseconds and
+    each generation's diff is encoded once and sent to every client. Clients
+    too slow to keep up have updates dropped rather than buffered without
+    end, and get a keyframe of the whole world once they've caught up."""
+    def __init__(self, world, settings, host="127.0.0.1", port=0,
+                 max_buffered=1 << 20):
+        self.world = world
+        self.settings = settings
+        self.host = host
+        self.port = port
+        self.max_buffered = max_buffered
+
+        self.phase = Phase.SETUP
+        self.connections = set()
+        self.handlers = set()
+        self.players = {}
+        self.server = None
+        self.ticker = None
+        self.finished = asyncio.Event()
+        # a MatchHost running this alongside other matches, which then
+        # decides when it ticks, and the evolve it has running, if any
+        self.match_host = None
+        self.evolving = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host,
+                                                 self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        if not self.world.setup.needs_user_input:
+            # no user input, just set it up!
+            self.world.set(self.world.setup.place_cells(compact=True))
+            self.begin_playing()
+
+    async def close(self):
+        if self.ticker is not None:
+            self.ticker.cancel()
+        self.server.close()
+        for connection in list(self.connections):
+            connection.writer.close()
+        # let every handler see its connection close, rather than being
+        # cancelled part way through
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        connection = None
+        self.handlers.add(asyncio.current_task())
+        try:
+            kind, payload = await read_message(reader)
+            if kind != Message.JOIN:
+                return
+            role = Role(join_format.unpack(payload)[0])
+            connection = Connection(reader, writer, self.free_team(role))
+            if connection.team != 0:
+                self.players[connection.team] = connection
+            if self.evolving is not None:
+                # wait for the world to settle before sending it
+                await asyncio.shield(self.evolving)
+            self.connections.add(connection)
+            self.welcome(connection)
+
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == Message.PLACE:
+                    self.place(connection, *place_format.unpack(payload))
+                else:
+                    self.error(connection, "Unexpected {}".format(kind.name))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.handlers.discard(asyncio.current_task())
+            if connection is not None:
+                self.connections.discard(connection)
+                if self.players.get(connection.team) is connection:
+                    # free for someone else to take over
+                    del self.players[connection.team]
+            writer.close()
+
+    def free_team(self, role):
+        if role == Role.PLAYER and self.world.setup.needs_user_input:
+            for team in range(1, self.world.setup.teams + 1):
+                if team not in self.players:
+                    return team
+        return 0
+
+    def welcome(self, connection):
+        world_x, world_y = self.world.setup.world_size
+        cells_each = getattr(self.world.setup, "num_cells_each", 0)
+        connection.writer.write(pack(Message.WELCOME, welcome_format.pack(
+            connection.team, world_x, world_y, self.world.setup.teams,
+            self.phase.value, cells_each)))
+        connection.writer.write(pack(Message.KEYFRAME, self.keyframe()))
+
+    def keyframe(self):
+        return encode_grid(self.world.generation, self.world.get_team_grid())
+
+    def error(self, connection, reason):
+        connection.writer.write(pack(Message.ERROR, reason.encode()))
+
+    # why a placement was turned down, as sent to its client
+    rejections = {
+        Setup.Placement.OUTSIDE_WORLD: "Outside the world",
+        Setup.Placement.NO_SUCH_TEAM: "Can't place cells now",
+        Setup.Placement.OCCUPIED: "Cell is already alive",
+        Setup.Placement.OUTSIDE_SEGMENT: "Outside your team's segment",
+        Setup.Placement.NO_CELLS_LEFT: "No cells left to place",
+    }
+
+    def place(self, connection, x, y):
+        team = connection.team
+        if self.phase != Phase.SETUP or team == 0:
+            return self.error(connection, "Can't place cells now")
+        placement = Setup.Placement(
+            self.world.place([(x, y)], [team], partial=True)[0])
+        if placement != Setup.Placement.PLACED:
+            return self.error(connection, self.rejections[placement])
+
+        world_y = self.world.setup.world_size[1]
+        index = np.array([x * world_y + y])
+        self.broadcast(pack(Message.DIFF, encode_diff(
+            self.world.generation, index, np.array([team]))))
+
+        if self.world.setup.setup_complete():
+            self.begin_playing()
+
+    def begin_playing(self):
+        self.set_phase(Phase.PLAYING)
+        if self.match_host is not None:
+            self.match_host.schedule(self)
+        else:
+            self.ticker = asyncio.get_running_loop().create_task(self.play())
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self.broadcast(pack(Message.PHASE, phase_format.pack(
+            phase.value, self.world.generation)), droppable=False)
+
+    async def play(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self.phase == Phase.PLAYING:
+            next_tick += self.settings.game_tick_wait / 1000.0
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            self.tick()
+
+    def tick(self):
+        self.world.evolve()
+        self.publish()
+
+    def publish(self):
+        # send out the generation just evolved
+        diff = self.world.diff
+        self.broadcast(pack(Message.DIFF, encode_diff(
+            self.world.generation, diff.indices, diff.new_teams)))
+        if self.world.finished():
+            self.set_phase(Phase.END)
+            self.finished.set()
+
+    def broadcast(self, message, droppable=True):
+        # updates to clients that are behind are dropped, as a keyframe will
+        # bring them up to date, but anything else has to get through
+        keyframe = None
+        for connection in list(self.connections):
+            writer = connection.writer
+            if not droppable:
+                writer.write(message)
+            elif writer.transport.get_write_buffer_size() > self.max_buffered:
+                connection.needs_keyframe = True
+            elif connection.needs_keyframe:
+                if keyframe is None:
+                    keyframe = pack(Message.KEYFRAME, self.keyframe())
+                writer.write(keyframe)
+                connection.needs_keyframe = False
+            else:
+                writer.write(message)
+
+
+async def serve(server):
+    await server.start()
+    print("Serving on port {}".format(server.port))
+    await server.finished.wait()
+    await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a multiplayer match")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--size", type=int, nargs=2, default=(50, 50),
+                        metavar=("X", "Y"))
+    parser.add_argument("--teams", type=int, default=4)
+    parser.add_argument("--cells-each", type=int, default=None,
+                        help="cells each player places (random setup if not "
+                             "given)")
+    parser.add_argument("--rules", default="cooperation")
+    parser.add_argument("--tick", type=float, default=100.0,
+                        help="milliseconds between generations")
+    args = parser.parse_args(argv)
+
+    if args.cells_each is None:
+        setup = Setup.create(tuple(args.size), args.teams, Setup.Names.RANDOM)
+    else:
+        setup = Setup.create(tuple(args.size), args.teams,
+                             Setup.Names.PLACE_CELLS,
+                             num_cells_each=args.cells_each)
+    rules = Rules.create(Rules.Name[args.rules.upper()])
+    world = World(setup, rules, compact=True)
+    settings = Settings(None, args.tick)
+    asyncio.run(serve(MatchServer(world, settings, args.host, args.port)))
+
+
+if __name__ == "__main__":
+    main()
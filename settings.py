@@ -1,4 +1,5 @@
 class Settings:
-    def __init__(self, res, game_tick_wait):
+    def __init__(self, res, game_tick_wait, max_fps=60):
         self.res = res
         self.game_tick_wait = game_tick_wait
+        self.max_fps = max_fps
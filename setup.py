@@ -5,16 +5,22 @@ from world import World
 from math import floor
 
 # TODO: Bring across other setup modes
-# TODO: Saving and loading setups (whether use user input or not)
 
 
 class Setup:
     """The possible ways in which to setup the world"""
-    def __init__(self, world_size, teams, segmented):
+    def __init__(self, world_size, teams, segmented, seed=None):
         self.world_size = world_size
         self.teams = teams
         self.needs_user_input = False
         self.segmented = segmented
+        # everything random about a setup comes from here, so a setup made
+        # with the same seed always places the same cells. seed can also be
+        # a np.random.Generator to share
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        # which team's segment each cell is in, worked out when first needed
+        self.segments = None
 
     class Names(Enum):
         RANDOM = 0
@@ -25,19 +31,108 @@ class Setup:
         EDGES = 1
         EDGES_NO_CORNERS = 2
 
+    # what became of each cell asked to be placed
+    class Placement(Enum):
+        PLACED = 0
+        OUTSIDE_WORLD = 1
+        NO_SUCH_TEAM = 2
+        OCCUPIED = 3            # alive already, or earlier in the batch
+        OUTSIDE_SEGMENT = 4
+        NO_CELLS_LEFT = 5
+
     # factory for inherited setup classes
     @staticmethod
     def create(world_size, teams, setup_name=Names.RANDOM,
                segmented=Segmented.NONE,
-               num_cells_each=None,):
+               num_cells_each=None, seed=None):
         if setup_name == Setup.Names.RANDOM:
-            return SetupRandom(world_size, teams, segmented=segmented)
+            return SetupRandom(world_size, teams, segmented=segmented,
+                               seed=seed)
         elif setup_name == Setup.Names.PLACE_CELLS:
             return SetupPlace(world_size, teams, segmented=segmented,
-                              num_cells_each=num_cells_each)
+                              num_cells_each=num_cells_each, seed=seed)
         else:
             raise NotImplementedError()
 
+    # setups are saved as the world once set up, e.g. by save_world() in
+    # replay.py, which works whether players placed the cells or not
+    @staticmethod
+    def load(path, generation=None):
+        from replay import ReplayReader
+        with ReplayReader(path) as reader:
+            if generation is None:
+                generation = reader.first_generation()
+            team_grid = reader.team_grid(generation)
+            return SetupSaved(team_grid, reader.replay.teams)
+
+    def get_segment_grid(self):
+        # compact grid of the team allowed to have cells in each cell, for
+        # segmented setups (0 where no team is)
+        if self.segments is None:
+            self.segments = World.make_segment_grid(
+                self.world_size, self.teams,
+                use_corners=self.segmented == Setup.Segmented.EDGES)
+        return self.segments
+
+    def check_placements(self, world_array, positions, teams):
+        # the Placement value each (x, y) position and team would get if
+        # placed in world_array now, all checked at once, and the positions
+        # as arrays of xs and ys
+        positions = np.asarray(positions, dtype=np.intp).reshape(-1, 2)
+        teams = np.asarray(teams, dtype=np.intp).reshape(-1)
+        xs, ys = positions[:, 0], positions[:, 1]
+        world_x, world_y = self.world_size
+        results = np.full(len(teams), Setup.Placement.PLACED.value,
+                          dtype=np.uint8)
+
+        def reject(where, placement):
+            # only the first reason a placement can't go ahead is kept
+            results[where & (results == Setup.Placement.PLACED.value)] = \
+                placement.value
+
+        inside = (xs >= 0) & (xs < world_x) & (ys >= 0) & (ys < world_y)
+        reject(~inside, Setup.Placement.OUTSIDE_WORLD)
+        reject((teams < 1) | (teams > self.teams),
+               Setup.Placement.NO_SUCH_TEAM)
+        # look up cells outside the world as if they were at (0, 0), as
+        # they've already been rejected
+        xs_inside, ys_inside = xs * inside, ys * inside
+        reject(World.are_cells_alive(world_array, xs_inside, ys_inside),
+               Setup.Placement.OCCUPIED)
+        if self.segmented != Setup.Segmented.NONE:
+            segments = self.get_segment_grid()[xs_inside, ys_inside]
+            reject(segments != teams, Setup.Placement.OUTSIDE_SEGMENT)
+        # of the placements left, only the first for each cell can go ahead
+        allowed = np.flatnonzero(results == Setup.Placement.PLACED.value)
+        cells = xs[allowed] * world_y + ys[allowed]
+        repeated = np.ones(len(allowed), dtype=bool)
+        repeated[np.unique(cells, return_index=True)[1]] = False
+        results[allowed[repeated]] = Setup.Placement.OCCUPIED.value
+        return results, xs, ys
+
+    def place_many(self, world_array, positions, teams, partial=False):
+        """Place the cells for teams at (x, y) positions in world_array (a
+        one-hot world array or compact team grid) all at once.
+
+        Every placement is checked first by check_placements(): against the
+        world's edges, the cells already alive and each team's segment, plus
+        whatever else the setup limits. Unless partial, any placement
+        failing raises a ValueError with nothing placed, otherwise just the
+        rest are. Returns the world array and each placement's Placement
+        value."""
+        results, xs, ys = self.check_placements(world_array, positions,
+                                                teams)
+        placed = results == Setup.Placement.PLACED.value
+        if not partial and not placed.all():
+            reasons = [Setup.Placement(value).name.lower().replace("_", " ")
+                       for value in np.unique(results[~placed])]
+            raise ValueError("{} of {} cells can't be placed: {}".format(
+                np.count_nonzero(~placed), len(results), ", ".join(reasons)))
+        teams = np.asarray(teams, dtype=np.intp).reshape(-1)[placed]
+        world_array = World.change_cells_teams(world_array, xs[placed],
+                                               ys[placed], teams)
+        return world_array, results
+
     def place_cells(self):
         raise NotImplementedError("This class shouldn't be used,"
                                   "it is an abstract base class")
@@ -48,45 +143,99 @@ class Setup:
 
 
 class SetupRandom(Setup):
-    def place_cells(self):
+    emptiness = 4.0
+
+    def place_cells(self, compact=False):
         if self.segmented == Setup.Segmented.NONE:
             team_grid = World.make_random_grid(self.world_size, self.teams,
-                                               emptiness=4.0)
-            return World.world_array_from_team_grid(team_grid)
-
-        elif self.segmented == Setup.Segmented.EDGES:
-            raise NotImplementedError("Not yet implemented, sorry!")
+                                               emptiness=self.emptiness,
+                                               rng=self.rng)
         else:
-            raise NotImplementedError("Not yet implemented, sorry!")
+            # every segment filled at once, as densely as unsegmented worlds,
+            # from a byte of randomness per cell
+            threshold = round(256 / (1.0 + self.emptiness))
+            alive = self.rng.integers(0, 256, size=self.world_size,
+                                      dtype=np.uint8) < threshold
+            team_grid = self.get_segment_grid() * alive
+
+        if compact:
+            return team_grid
+        return World.world_array_from_team_grid(team_grid, self.teams)
 
     def setup_complete(self):
         return True
 
 
 class SetupPlace(Setup):
-    def __init__(self, world_size, teams, segmented, num_cells_each):
-        Setup.__init__(self, world_size, teams, segmented)
+    def __init__(self, world_size, teams, segmented, num_cells_each,
+                 seed=None):
+        Setup.__init__(self, world_size, teams, segmented, seed)
         self.needs_user_input = True
         x, y = world_size
+        # the room each team has to place cells in
+        if segmented == Setup.Segmented.NONE:
+            space = x*y/teams
+        else:
+            space = np.bincount(self.get_segment_grid().ravel(),
+                                minlength=teams + 1)[1:].min()
         if num_cells_each is None:
-            self.num_cells_each = floor(0.2*x*y/teams)
-        elif num_cells_each*teams > x*y:
+            self.num_cells_each = floor(0.2*space)
+        elif num_cells_each > space:
             raise ValueError("The world isn't big enough for this many cells!")
         else:
             self.num_cells_each = num_cells_each
-        self.placing_rounds_complete = 0
+        # cells placed by each team so far, indexed by team
+        self.placed = np.zeros(teams + 1, dtype=np.int64)
 
     def place_cells(self, world_array, team, cursor_pos):
-        if self.segmented == Setup.Segmented.NONE:
-            # use cursor_pos and team to add a live cell to world map
-            new_world_array = World.change_cell_team(world_array,
-                                                     cursor_pos,
-                                                     team)
-            if team == self.teams:
-                self.placing_rounds_complete += 1
-            return new_world_array
-        else:
-            raise NotImplementedError("Not yet implemented, sorry!")
+        # use cursor_pos and team to add a live cell to world map (either
+        # a one-hot world array or a compact team grid)
+        new_world_array, _ = self.place_many(world_array, [cursor_pos],
+                                             [team])
+        return new_world_array
+
+    def check_placements(self, world_array, positions, teams):
+        results, xs, ys = Setup.check_placements(self, world_array,
+                                                 positions, teams)
+        # each team's placements in order, numbered from how many cells it
+        # has placed already, run out once they reach num_cells_each
+        teams = np.asarray(teams, dtype=np.intp).reshape(-1)
+        allowed = np.flatnonzero(results == Setup.Placement.PLACED.value)
+        if len(allowed):
+            allowed_teams = teams[allowed]
+            order = np.argsort(allowed_teams, kind="stable")
+            sorted_teams = allowed_teams[order]
+            group_starts = np.searchsorted(sorted_teams, sorted_teams)
+            numbers = np.empty(len(order), dtype=np.int64)
+            numbers[order] = np.arange(len(order)) - group_starts
+            numbers += self.placed[allowed_teams]
+            results[allowed[numbers >= self.num_cells_each]] = \
+                Setup.Placement.NO_CELLS_LEFT.value
+        return results, xs, ys
+
+    def place_many(self, world_array, positions, teams, partial=False):
+        world_array, results = Setup.place_many(self, world_array, positions,
+                                                teams, partial)
+        # count them against each team's num_cells_each
+        placed = results == Setup.Placement.PLACED.value
+        teams = np.asarray(teams, dtype=np.intp).reshape(-1)[placed]
+        self.placed += np.bincount(teams, minlength=self.teams + 1)
+        return world_array, results
+
+    def setup_complete(self):
+        return bool((self.placed[1:] >= self.num_cells_each).all())
+
+
+class SetupSaved(Setup):
+    """A world set up earlier and loaded back from a file"""
+    def __init__(self, team_grid, teams):
+        Setup.__init__(self, team_grid.shape, teams, Setup.Segmented.NONE)
+        self.team_grid = team_grid
+
+    def place_cells(self, compact=False):
+        if compact:
+            return self.team_grid.copy()
+        return World.world_array_from_team_grid(self.team_grid, self.teams)
 
     def setup_complete(self):
-        return self.placing_rounds_complete >= self.num_cells_each
+        return True
@@ -0,0 +1,165 @@
+import numpy as np
+
+
+class Stats:
+    """Per team statistics for a world, kept up to date from each
+    generation's diff instead of by rescanning the world.
+
+    Updating them costs in proportion to the cells in the diff, and the
+    dense, parallel and tiled engines hand over the cells that changed from
+    the deaths and births they work out while evolving. Only Hashlife, which
+    builds each result whole, leaves the diff to be found by comparing the
+    whole world.
+
+    For every team (indexed by team id, with 0 for dead cells) there are the
+    live population, the births, deaths and captures in the latest generation
+    (and totals since loading), the territory held, and the bounding box of
+    its live cells. A cell stays a team's territory after its cells there die,
+    until another team is born there or converts it, which counts as a
+    capture. The last length generations are kept as a time series for
+    scoring and live displays."""
+    series_names = ("population", "births", "deaths", "captured", "territory",
+                    "bounding_boxes")
+
+    def __init__(self, teams, length=1024):
+        self.teams = teams
+        self.length = length
+        self.clear()
+
+    def clear(self):
+        # forget everything, e.g. after the world was changed by hand
+        self.loaded = False
+
+    def load(self, team_grid, generation):
+        if team_grid.size != 0:
+            # allowing for worlds set with more teams than they were made for
+            self.teams = max(self.teams, int(team_grid.max()))
+        teams = self.teams + 1
+        self.shape = team_grid.shape
+        world_x, world_y = self.shape
+
+        # the last team to hold each cell
+        self.owner = np.array(team_grid)
+        self.population = np.bincount(team_grid.ravel(), minlength=teams)
+        self.territory = self.population.copy()
+        self.territory[0] = 0
+        # live cells of each team in each row and column, to keep bounding
+        # boxes without searching the world for them
+        xs, ys = np.indices(self.shape)
+        team_grid = team_grid.astype(np.intp)
+        self.row_counts = np.bincount(
+            (team_grid * world_x + xs).ravel(),
+            minlength=teams * world_x).reshape(teams, world_x)
+        self.column_counts = np.bincount(
+            (team_grid * world_y + ys).ravel(),
+            minlength=teams * world_y).reshape(teams, world_y)
+
+        self.births = np.zeros(teams, dtype=np.int64)
+        self.deaths = np.zeros(teams, dtype=np.int64)
+        self.captured = np.zeros(teams, dtype=np.int64)
+        self.total_births = np.zeros(teams, dtype=np.int64)
+        self.total_deaths = np.zeros(teams, dtype=np.int64)
+        self.total_captured = np.zeros(teams, dtype=np.int64)
+
+        # ring buffers of the time series, written at count % length
+        self.generations = np.zeros(self.length, dtype=np.int64)
+        self.series = {name: np.zeros((self.length, teams), dtype=np.int64)
+                       for name in Stats.series_names}
+        self.series["bounding_boxes"] = np.zeros((self.length, teams, 4),
+                                                 dtype=np.int64)
+        self.count = 0
+        self.loaded = True
+        self.remember(generation)
+
+    def record(self, diff, generation):
+        # update from a Diff between the last generation recorded and this one
+        moves, self.captured = self.apply(diff)
+        self.births = moves[0]
+        self.deaths = moves[:, 0]
+        self.total_births += self.births
+        self.total_deaths += self.deaths
+        self.total_captured += self.captured
+        self.remember(generation)
+
+    def edit(self, diff):
+        # cells changed by hand, which change each team's cells and territory
+        # but aren't the births, deaths or captures of any generation
+        if self.loaded:
+            self.apply(diff)
+
+    def apply(self, diff):
+        # move the cells in diff to their new teams, returning how many cells
+        # went from each team to each other team, and the captures by each
+        teams = self.teams + 1
+        old_teams = diff.old_teams.astype(np.intp)
+        new_teams = diff.new_teams.astype(np.intp)
+
+        moves = np.bincount(old_teams * teams + new_teams,
+                            minlength=teams * teams).reshape(teams, teams)
+        self.population += moves.sum(axis=0) - moves.sum(axis=1)
+
+        # cells taken over from whichever team last held them
+        owner = self.owner.ravel()
+        occupied = new_teams != 0
+        new_owners = new_teams[occupied]
+        indices = diff.indices[occupied]
+        old_owners = owner[indices].astype(np.intp)
+        changed_hands = old_owners != new_owners
+        captures = changed_hands & (old_owners != 0)
+        captured = np.bincount(new_owners[captures], minlength=teams)
+        self.territory += np.bincount(new_owners[changed_hands],
+                                      minlength=teams)
+        self.territory -= np.bincount(old_owners[changed_hands],
+                                      minlength=teams)
+        self.territory[0] = 0
+        owner[indices] = new_owners
+
+        xs, ys = diff.positions()
+        Stats.move(self.row_counts, old_teams, new_teams, xs)
+        Stats.move(self.column_counts, old_teams, new_teams, ys)
+        return moves, captured
+
+    @staticmethod
+    def move(counts, old_teams, new_teams, lines):
+        # move cells in the given rows or columns from their old teams' counts
+        # to their new ones
+        size = counts.size
+        length = counts.shape[1]
+        counts.ravel()[:] += np.bincount(new_teams * length + lines,
+                                         minlength=size)
+        counts.ravel()[:] -= np.bincount(old_teams * length + lines,
+                                         minlength=size)
+
+    def bounding_boxes(self):
+        # (teams + 1, 4) inclusive (x0, y0, x1, y1) around each team's live
+        # cells, all -1 for teams with none
+        boxes = np.full((self.teams + 1, 4), -1, dtype=np.int64)
+        for axis, counts in enumerate((self.row_counts, self.column_counts)):
+            live = counts > 0
+            present = live.any(axis=1)
+            first = live.argmax(axis=1)
+            last = live.shape[1] - 1 - live[:, ::-1].argmax(axis=1)
+            boxes[present, axis] = first[present]
+            boxes[present, axis + 2] = last[present]
+        return boxes
+
+    def remember(self, generation):
+        slot = self.count % self.length
+        self.generations[slot] = generation
+        self.series["population"][slot] = self.population
+        self.series["births"][slot] = self.births
+        self.series["deaths"][slot] = self.deaths
+        self.series["captured"][slot] = self.captured
+        self.series["territory"][slot] = self.territory
+        self.series["bounding_boxes"][slot] = self.bounding_boxes()
+        self.count += 1
+
+    def time_series(self, name):
+        # (generations, values) for the generations still kept, oldest first
+        kept = min(self.count, self.length)
+        slots = (np.arange(self.count - kept, self.count)) % self.length
+        return self.generations[slots], self.series[name][slots]
+
+    def scores(self):
+        # each team's score is the territory it holds
+        return self.territory[1:]
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+# run with python -m pytest from this directory, so the modules import as
+# they do when running the game. Drawing is checked without a window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+pygame = pytest.importorskip("pygame")
+
+from rendering import Screen
+from world import World
+from setup import Setup
+from rules import Rules
+
+
+def sparse_world(world_size, seed):
+    # a few small random patches in an empty world, so each generation
+    # changes few enough cells to be drawn incrementally
+    setup = Setup.create(world_size, 4, Setup.Names.RANDOM, seed=seed)
+    world = World(setup, Rules.create(), compact=True)
+    team_grid = np.zeros(world_size, dtype=World.team_dtype(4))
+    rng = np.random.default_rng(seed)
+    for _ in range(6):
+        x = rng.integers(0, world_size[0] - 8)
+        y = rng.integers(0, world_size[1] - 8)
+        team_grid[x:x + 8, y:y + 8] = rng.integers(0, 5, (8, 8)) \
+            * (rng.random((8, 8)) < 0.4)
+    world.set(team_grid)
+    return world
+
+
+@pytest.mark.parametrize("res, world_size, zoom", [
+    ((400, 300), (80, 60), None),
+    ((640, 480), (123, 77), None),
+    ((500, 500), (400, 400), None),
+    ((640, 480), (123, 77), (2.7, (301, 187))),
+])
+def test_incremental_redraw_matches_full_redraw(res, world_size, zoom):
+    screen = Screen(res)
+    world = sparse_world(world_size, seed=sum(res))
+    screen.update_scaling(world)
+    if zoom is not None:
+        factor, around = zoom
+        screen.zoom(factor, around)
+    world.render(screen)
+
+    incremental = []
+    draw_team_changes = screen.draw_team_changes
+
+    def recording_draw_team_changes(diff, palette):
+        incremental.append(draw_team_changes(diff, palette))
+        return incremental[-1]
+    screen.draw_team_changes = recording_draw_team_changes
+
+    for _ in range(5):
+        world.evolve()
+        world.render(screen)
+    assert incremental and all(incremental)
+    drawn = pygame.surfarray.array2d(screen.canvas)
+
+    screen.drawn = None
+    world.render(screen)
+    np.testing.assert_array_equal(drawn,
+                                  pygame.surfarray.array2d(screen.canvas))
+
+
+def test_draw_block_matches_full_redraw():
+    screen = Screen((640, 480))
+    world = sparse_world((123, 77), seed=3)
+    screen.update_scaling(world)
+    screen.zoom(3.3, (100, 100))
+    world.render(screen)
+
+    (start_x, stop_x), (start_y, stop_y) = screen.visible_cells()
+    team_grid = world.get_team_grid()
+    for x in range(start_x, stop_x, 5):
+        for y in range(start_y, stop_y, 3):
+            screen.draw_block((x, y), tuple(
+                world.team_colours.palette[team_grid[x, y]]))
+    # redrawing blocks the canvas already shows changes nothing
+    np.testing.assert_array_equal(pygame.surfarray.array2d(screen.screen),
+                                  pygame.surfarray.array2d(screen.canvas))
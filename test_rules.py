@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+# run with python -m pytest from this directory, so the modules import as
+# they do when running the game
+from rules import Rules
+
+
+def ignorance_generation(team_grid):
+    # one generation of RulesIgnorance worked out cell by cell: every team
+    # lives and breeds by Conway's rules counting only its own neighbours,
+    # and a dead cell two teams could both breed into stays dead
+    x, y = team_grid.shape
+    out = np.zeros_like(team_grid)
+    for i in range(x):
+        for j in range(y):
+            counts = {}
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    ni, nj = i + di, j + dj
+                    if (di or dj) and 0 <= ni < x and 0 <= nj < y \
+                            and team_grid[ni, nj]:
+                        team = team_grid[ni, nj]
+                        counts[team] = counts.get(team, 0) + 1
+            team = team_grid[i, j]
+            if team:
+                out[i, j] = team if counts.get(team, 0) in (2, 3) else 0
+            else:
+                breeding = [team for team, count in counts.items()
+                            if count == 3]
+                out[i, j] = breeding[0] if len(breeding) == 1 else 0
+    return out
+
+
+def test_ignorance_breeds_teams_outnumbered_by_another():
+    # team 1 has 3 neighbours around the middle cell, team 2 has 4
+    team_grid = np.zeros((5, 5), dtype=np.uint8)
+    for position in ((1, 1), (1, 2), (1, 3)):
+        team_grid[position] = 1
+    for position in ((2, 1), (2, 3), (3, 1), (3, 3)):
+        team_grid[position] = 2
+    result = Rules.create(Rules.Name.IGNORANCE).evolve(team_grid)
+    assert result[2, 2] == 1
+
+
+@pytest.mark.parametrize("engine", [Rules.Engine.DENSE,
+                                    Rules.Engine.HASHLIFE,
+                                    Rules.Engine.PARALLEL])
+def test_ignorance_matches_cell_by_cell(engine):
+    rng = np.random.default_rng(0)
+    rules = Rules.create(Rules.Name.IGNORANCE, engine=engine)
+    for _ in range(3):
+        team_grid = (rng.integers(0, 4, (23, 19))
+                     * (rng.random((23, 19)) < 0.6)).astype(np.uint8)
+        expected = ignorance_generation(team_grid)
+        np.testing.assert_array_equal(rules.evolve(team_grid.copy()),
+                                      expected)
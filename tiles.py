@@ -0,0 +1,105 @@
+import numpy as np
+from math import ceil
+
+from rules import Rules, EvolveBuffers
+
+
+class Tiles:
+    """Evolves a compact team grid in fixed size square tiles, skipping tiles
+    that can't have changed.
+
+    A tile is only recomputed if it, or one of the 8 tiles around it, changed
+    in the previous generation. Skipped tiles need no work at all: the buffer
+    being written into holds the generation before last, which is the same as
+    the last one for any tile that didn't change."""
+    def __init__(self, tile_size=64):
+        self.tile_size = tile_size
+        self.buffers = None
+        self.tile_buffers = {}
+        self.changed = None
+        self.changed_cells = None
+
+        # per tick counts, for the most recent evolve
+        self.active_tiles = 0
+        self.changed_tiles = 0
+
+    def tile_grid_shape(self, team_grid):
+        x, y = team_grid.shape
+        return ceil(x / self.tile_size), ceil(y / self.tile_size)
+
+    def total_tiles(self):
+        if self.changed is None:
+            return 0
+        return self.changed.size
+
+    def forget(self):
+        # the last grid returned was changed in place by something other than
+        # evolving, so no tile can be skipped next time
+        self.changed = None
+
+    def evolve(self, rules, team_grid):
+        if self.buffers is None or not self.buffers.fits(team_grid):
+            self.buffers = EvolveBuffers(team_grid.shape, team_grid.dtype)
+            self.changed = None
+        buffers = self.buffers
+
+        if not any(team_grid.base is padded for padded in buffers.padded):
+            # a grid from elsewhere (setup, loading, etc.), so the spare
+            # buffer knows nothing about it
+            self.changed = None
+        padded = buffers.load(team_grid, rules.borders)
+        result_padded = buffers.spare()
+        result_team_grid = EvolveBuffers.interior(result_padded)
+
+        if self.changed is None:
+            active = np.ones(self.tile_grid_shape(team_grid), dtype=bool)
+        else:
+            active = self.active_from_changed(self.changed, rules.borders)
+        changed = np.zeros(active.shape, dtype=bool)
+        changed_cells = []
+
+        size = self.tile_size
+        x, y = team_grid.shape
+        for tx, ty in zip(*np.nonzero(active)):
+            x0, y0 = tx * size, ty * size
+            x1, y1 = min(x0 + size, x), min(y0 + size, y)
+            block = padded[x0:x1 + 2, y0:y1 + 2]
+            out = result_team_grid[x0:x1, y0:y1]
+            cells = rules.evolve_padded(block, out, self.buffers_for(out),
+                                        changed=True)
+            if len(cells):
+                changed[tx, ty] = True
+                xs, ys = np.divmod(cells, y1 - y0)
+                changed_cells.append((xs + x0) * y + ys + y0)
+
+        self.changed = changed
+        # flat indices of the cells that changed, in order, from the deaths
+        # and births in the active tiles
+        self.changed_cells = np.sort(np.concatenate(changed_cells)) \
+            if changed_cells else np.zeros(0, dtype=np.intp)
+        self.active_tiles = int(np.count_nonzero(active))
+        self.changed_tiles = int(np.count_nonzero(changed))
+        buffers.current = 1 - buffers.current
+        return result_team_grid
+
+    def buffers_for(self, block):
+        # edge tiles may be smaller, so keep scratch space for each shape
+        if block.shape not in self.tile_buffers:
+            self.tile_buffers[block.shape] = EvolveBuffers(
+                block.shape, block.dtype, double_buffered=False)
+        return self.tile_buffers[block.shape]
+
+    @staticmethod
+    def active_from_changed(changed, borders):
+        # every changed tile and its 8 neighbours, wrapping around the edges
+        # of a toroidal world
+        padded = np.zeros((changed.shape[0] + 2, changed.shape[1] + 2),
+                          dtype=np.uint8)
+        padded[1:-1, 1:-1] = changed
+        if borders == Rules.Borders.TOROIDAL:
+            Rules.fill_halo(padded, borders)
+        neighbours = np.zeros(changed.shape, dtype=np.uint8)
+        row_sums = np.zeros((changed.shape[0] + 2, changed.shape[1]),
+                            dtype=np.uint8)
+        Rules.sum_neighbours(padded, row_sums, neighbours)
+        return np.logical_or(changed, neighbours != 0)
@@ -1,21 +1,52 @@
+import weakref
 import numpy as np
+from enum import Enum
 from math import floor
-from colours import Colours
 from time import monotonic
-from rendering import Screen
-import pygame
+
+from history import History
+from instruments import timed
+from pyramid import Pyramid
+from stats import Stats
 
 
 class World:
     """The world upon which the Game of Life occurs"""
+    class Stream(Enum):
+        TEAM_GRIDS = 0  # the world's own (x, y) team grid
+        DIFFS = 1       # the Diff from each generation to the next
+        FRAMES = 2      # (y, x, 3) RGB images, coloured by team
+
     # instance variables
 
-    def __init__(self, setup, rules):
+    def __init__(self, setup, rules, compact=False, borders=None, tiles=None):
         self.array = None
         self.setup = None
         self.rules = None
+        # compact worlds store one team id per cell in a (x, y) grid, instead
+        # of a (x, y, teams) one-hot array
+        self.compact = compact
+        self._team_colours = None
+        # optional Tiles, to only evolve the parts of the world that change
+        if tiles is not None and not compact:
+            raise ValueError("Tiled evolution needs a compact world")
+        self.tiles = tiles
+        # bumped on every change to the world, with the cells that changed in
+        # the most recent evolve kept in diff
+        self.version = 0
+        self.diff = None
+        # how many generations the world has evolved for, and the recent
+        # states, to tell when it's finished
+        self.generation = 0
+        self.history = History()
+        # per team statistics, made for the number of teams in reset()
+        self.stats = None
+        # coarser levels of detail to draw from, only kept up to date once
+        # something has asked for them
+        self.pyramid = None
         self.reset(setup=setup, rules=rules)
-        self.team_colours = Colours(setup.teams)
+        if borders is not None:
+            self.borders = borders
 
         self.set_last_evolution_millis()
 
@@ -24,6 +55,23 @@ class World:
             self.evolve()
             self.set_last_evolution_millis()
 
+    @property
+    def team_colours(self):
+        # only made when first needed, as colours need pygame
+        if self._team_colours is None:
+            from colours import Colours
+            self._team_colours = Colours(self.setup.teams)
+        return self._team_colours
+
+    @property
+    def borders(self):
+        # how the edges of the world behave, one of Rules.Borders
+        return self.rules.borders
+
+    @borders.setter
+    def borders(self, borders):
+        self.rules.borders = borders
+
     def time_since_last_evolution(self):
         return monotonic() * 1000 - self.last_world_update_millis
 
@@ -33,47 +81,164 @@ class World:
     def set_last_evolution_millis(self):
         self.last_world_update_millis = monotonic() * 1000
 
+    @timed("world.evolve")
     def evolve(self):
-        self.array = self.rules.evolve(self.array)
-
+        # evolved grids are written into separate buffers, so the old one is
+        # still intact to diff against
+        old_team_grid = self.get_team_grid()
+        if self.tiles is not None:
+            self.array = self.tiles.evolve(self.rules, self.array)
+            changed_cells = self.tiles.changed_cells
+        else:
+            self.array = self.rules.evolve(self.array)
+            changed_cells = self.rules.changed_cells
+        self.generation += 1
+        self.record_diff(old_team_grid, changed_cells=changed_cells)
+
+    def advance(self, generations):
+        # jump forward many generations at once, which engines like Hashlife
+        # can do far faster than evolving one at a time
+        old_team_grid = self.get_team_grid().copy()
+        self.array = self.rules.advance(self.array, generations)
+        self.generation += generations
+        self.record_diff(old_team_grid, generations)
+
+    def record_diff(self, old_team_grid, generations=1, changed_cells=None):
+        # changed_cells are the flat indices of the cells that changed, if the
+        # engine knows them, saving comparing the whole grid
+        self.version += 1
+        self.diff = Diff.between(old_team_grid, self.get_team_grid(),
+                                 self.version - 1, self.version,
+                                 changed_cells)
+        if not self.history.loaded:
+            self.history.load(old_team_grid, self.generation - generations)
+        self.history.record(self.diff, self.generation)
+        if not self.stats.loaded:
+            self.stats.load(old_team_grid, self.generation - generations)
+        self.stats.record(self.diff, self.generation)
+        if self.pyramid is not None and self.pyramid.loaded:
+            self.pyramid.record(self.diff, self.get_team_grid())
+
+    def finished(self):
+        # whether the world has died out, stopped changing, or is just
+        # repeating itself
+        return self.history.finished()
+
+    def stream(self, generations=None, output=Stream.TEAM_GRIDS, scale=1,
+               until_finished=False):
+        """Evolve the world lazily, yielding (generation, output) as it goes.
+
+        Team grids and frames start from the world as it is now, diffs from
+        the first generation evolved. Team grids are the world's own array,
+        so are only valid until the next one is asked for."""
+        if output != World.Stream.DIFFS:
+            yield self.generation, self.output(output, scale)
+        evolved = 0
+        while generations is None or evolved < generations:
+            if until_finished and self.finished():
+                return
+            self.evolve()
+            evolved += 1
+            yield self.generation, self.output(output, scale)
+
+    def output(self, output, scale=1):
+        if output == World.Stream.TEAM_GRIDS:
+            return self.get_team_grid()
+        elif output == World.Stream.DIFFS:
+            return self.diff
+        return self.frame(scale)
+
+    def frame(self, scale=1):
+        # the world as an RGB image, rows of it running along y, with each
+        # cell scale pixels square
+        image = self.get_team_grid().T
+        if scale != 1:
+            image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+        return self.team_colours.palette[image]
+
+    @timed("world.render")
     def render(self, screen):
-        # TODO: there will be a more efficient way to do this
-        team_grid = self.team_grid_from_world_array(self.array)
-        for x in range(len(team_grid)):
-            for y in range(len(team_grid[0])):
-                screen.draw_block((x, y), self.get_team_colour(team_grid[x][y]))
+        screen.draw_world(self)
 
     def reset(self, setup=None, world_size=None, teams=None, rules=None):
         if setup is not None:
             self.setup = setup
+            self._team_colours = None
+            self.generation = 0
+            self.stats = Stats(setup.teams)
             world_x, world_y = setup.world_size
             # self.array = np.zeros((world_x, world_y, setup.teams))
             self.create_empty_world_array(setup.world_size, setup.teams)
         elif world_size == -1 and teams == -1:
             self.array.fill(0)
         else:
+            self.stats = Stats(teams)
             self.create_empty_world_array(world_size, teams)
+        self.changed()
 
         if rules is not None:
+            World.claim(rules, self)
             self.rules = rules
         else:
             # Leave the rules as they are
             pass
 
+    @staticmethod
+    def claim(rules, world):
+        # rules evolve into buffers of their own and hand back views of
+        # them, so one set of rules can only be evolving one world
+        owner = getattr(rules, "world", None)
+        if owner is not None and owner() not in (None, world):
+            raise ValueError("These rules are already evolving another "
+                             "world, give each World its own Rules.create()")
+        rules.world = weakref.ref(world)
+
     def create_empty_world_array(self, world_size, teams):
         world_x, world_y = world_size
-        self.array = np.zeros((world_x, world_y, teams), dtype=int)
+        if self.compact:
+            self.array = np.zeros((world_x, world_y),
+                                  dtype=self.team_dtype(teams))
+        else:
+            self.array = np.zeros((world_x, world_y, teams), dtype=int)
 
     def set(self, new_array):
         self.array = new_array
+        self.changed()
+
+    def changed(self):
+        # the world was changed some other way than evolving, so there's no
+        # diff from the last version, and its history no longer follows on
+        self.version += 1
+        self.diff = None
+        self.history.clear()
+        self.stats.clear()
+        if self.pyramid is not None:
+            self.pyramid.clear()
+        if self.tiles is not None:
+            self.tiles.forget()
+        if self.rules is not None:
+            self.rules.forget()
+
+    def get_team_grid(self):
+        if self.compact:
+            return self.array
+        return self.team_grid_from_world_array(self.array)
+
+    def level_of_detail(self):
+        # the world's Pyramid of levels of detail, up to date with it
+        if self.pyramid is None:
+            self.pyramid = Pyramid()
+        if not self.pyramid.loaded:
+            self.pyramid.load(self.get_team_grid())
+        return self.pyramid
 
     def get_team_colour(self, team):
         return self.team_colours.get_team_colour(team)
 
-    def size_segment_grid(self, use_corners=True):
+    @staticmethod
+    def size_segment_grid(world_size, teams, use_corners=True):
         # Get relevant info
-        world_x, world_y = self.array.shape
-        teams = self.setup.teams
+        world_x, world_y = world_size
         if use_corners:
             required_segments = teams
         else:
@@ -81,78 +246,185 @@ class World:
 
         # Begin with an approximation, will either be correct or be just above
         # the largest square number that is too small
-        segment_x_guess = floor(4 * world_x / (required_segments + 4))
-        segment_y_guess = floor(4 * world_y / (required_segments + 4))
+        segment_x_guess = max(1, floor(4 * world_x / (required_segments + 4)))
+        segment_y_guess = max(1, floor(4 * world_y / (required_segments + 4)))
 
-        segments_in_x = floor(world_x / segment_x_guess)
-        segments_in_y = floor(world_y / segment_y_guess)
+        # at least two segments each way, so every segment is on an edge
+        segments_in_x = max(2, floor(world_x / segment_x_guess))
+        segments_in_y = max(2, floor(world_y / segment_y_guess))
 
         # add extra segments (by making segment sizes more square where
         # possible) until there are enough segments for all the teams
         while 2 * (segments_in_x + segments_in_y - 2) < required_segments:
             # not enough segments, so divide the larger edge further
-            if segment_x_guess > segment_y_guess:
+            if world_x / segments_in_x > world_y / segments_in_y:
                 segments_in_x += 1
             else:
                 segments_in_y += 1
 
+        if segments_in_x > world_x or segments_in_y > world_y:
+            raise ValueError("The world is too small to give {} teams a "
+                             "segment each".format(teams))
+
         # now that number of segments is set well (filling around edge as best
         # as possible, matching the aspect ratio of the world pretty closely),
         # return recalculated segment size
-        return floor(world_x / segments_in_x), floor(world_x / segments_in_y),\
-               teams
+        return floor(world_x / segments_in_x), floor(world_y / segments_in_y),\
+               segments_in_x, segments_in_y
+
+    @staticmethod
+    def make_segment_grid(world_size, teams, use_corners=True):
+        # a compact grid of which team owns each cell's segment, with the
+        # teams' segments spread evenly around the edge of the world, and 0
+        # for every cell outside them
+        world_x, world_y = world_size
+        _, _, segments_in_x, segments_in_y = World.size_segment_grid(
+            world_size, teams, use_corners)
+        # where each segment starts and ends, spreading any cells left over
+        edges_x = np.arange(segments_in_x + 1) * world_x // segments_in_x
+        edges_y = np.arange(segments_in_y + 1) * world_y // segments_in_y
+
+        # the segments around the edge, in order round from (0, 0)
+        last_x, last_y = segments_in_x - 1, segments_in_y - 1
+        ring = [(x, 0) for x in range(last_x)] + \
+               [(last_x, y) for y in range(last_y)] + \
+               [(x, last_y) for x in range(last_x, 0, -1)] + \
+               [(0, y) for y in range(last_y, 0, -1)]
+        if not use_corners:
+            corners = {(0, 0), (last_x, 0), (0, last_y), (last_x, last_y)}
+            ring = [segment for segment in ring if segment not in corners]
+
+        segment_grid = np.zeros(world_size, dtype=World.team_dtype(teams))
+        chosen = np.arange(teams) * len(ring) // teams
+        for team, segment in enumerate(chosen, 1):
+            sx, sy = ring[segment]
+            block = np.full((edges_x[sx + 1] - edges_x[sx],
+                             edges_y[sy + 1] - edges_y[sy]), team,
+                            dtype=segment_grid.dtype)
+            World.replace_array_subset(segment_grid, block,
+                                       (edges_x[sx], edges_y[sy]))
+        return segment_grid
 
     def is_cell_alive(self, position):
         x, y = position
-        for team in range(self.setup.teams):
-            if self.array[x, y, team-1] == 1:
-                return True
+        return bool(World.are_cells_alive(self.array, [x], [y])[0])
 
-        return False
+    @staticmethod
+    def are_cells_alive(world_array, xs, ys):
+        # whether each cell (xs[i], ys[i]) of a one-hot world array or
+        # compact team grid has a live cell of any team
+        cells = world_array[np.asarray(xs), np.asarray(ys)]
+        if world_array.ndim == 2:
+            return cells != 0
+        return cells.any(axis=-1)
+
+    def place(self, positions, teams, partial=False):
+        """Place cells for many teams at once, as (x, y) positions and the
+        team for each, with the setup checking them all first.
+
+        Returns each placement's Setup.Placement value. Unless partial, a
+        single placement the setup won't allow raises a ValueError and
+        leaves the world as it was, otherwise just the allowed ones are
+        placed."""
+        from setup import Setup
+        positions = np.asarray(positions, dtype=np.intp).reshape(-1, 2)
+        teams = np.asarray(teams, dtype=np.intp).reshape(-1)
+        self.array, results = self.setup.place_many(self.array, positions,
+                                                    teams, partial)
+        placed = results == Setup.Placement.PLACED.value
+        indices = np.ravel_multi_index(
+            (positions[placed, 0], positions[placed, 1]),
+            self.setup.world_size)
+        order = np.argsort(indices)
+        new_teams = teams[placed][order].astype(
+            World.team_dtype(self.setup.teams))
+        # cells are only ever placed where there were none
+        self.record_edit(Diff(self.setup.world_size, indices[order],
+                              np.zeros_like(new_teams), new_teams,
+                              self.version, self.version + 1))
+        return results
+
+    def record_edit(self, diff):
+        # the world was changed by hand in just the cells of diff, so what's
+        # kept up to date from diffs can follow it instead of starting over
+        self.version += 1
+        self.diff = diff
+        if self.tiles is not None:
+            self.tiles.forget()
+        if self.rules is not None:
+            self.rules.forget()
+        self.history.edit(diff)
+        self.stats.edit(diff)
+        if self.pyramid is not None and self.pyramid.loaded:
+            self.pyramid.record(diff, self.get_team_grid())
 
     @staticmethod
     def replace_array_subset(array, subset, index):
-        # TODO: raise Exception if array, subset, index have dif num dimensions
-        index_other_end = np.empty(index.shape)
+        # write subset into array, with its first element at index
+        if array.ndim != subset.ndim or array.ndim != len(index):
+            raise ValueError("Array, subset and index must have the same "
+                             "number of dimensions")
         # for each dimension of the arrays
-        for ii in range(len(array.shape)):
-            if index[ii] < 0 or index[ii] >= array[ii]:
+        for ii in range(array.ndim):
+            if index[ii] < 0 or index[ii] >= array.shape[ii]:
                 raise IndexError("Index out of bounds")
             if index[ii] + subset.shape[ii] > array.shape[ii]:
                 raise ValueError("Subset too large for list at this index")
-            index_other_end[ii] = index[ii] + index.shape[ii]
-
-        # TODO: LEFT UNFINISHED?
-        np.put(array, )
 
+        array[tuple(slice(start, start + size)
+                    for start, size in zip(index, subset.shape))] = subset
+        return array
 
     @staticmethod
-    def make_random_grid(size, teams, emptiness=1.0, first_team=1):
+    def make_random_grid(size, teams, emptiness=1.0, first_team=1, rng=None):
+        # a compact team grid, drawn from rng (a np.random.Generator, or a
+        # seed for one) so the same seed always gives the same grid
+        rng = np.random.default_rng(rng)
         emptiness_lower_bound = 1 - floor(teams * emptiness)
         options = np.arange(emptiness_lower_bound, teams + 1)
         options[options < 0] = 0
         options += (first_team - 1)
-        return np.random.choice(options, size=size)
+        # choices are drawn as small unsigned ints and then looked up into
+        # the grid's own team type, instead of going through an int64 grid
+        choices = rng.integers(0, len(options), size=size,
+                               dtype=World.team_dtype(len(options)))
+        return options.astype(World.team_dtype(options.max()))[choices]
 
     @staticmethod
     def make_empty_grid(size):
         return np.zeros(size)
 
+    @staticmethod
+    def team_dtype(teams):
+        # smallest unsigned type that can hold every team id (0 is dead)
+        if teams <= np.iinfo(np.uint8).max:
+            return np.uint8
+        return np.uint16
+
     @staticmethod
     def change_cell_team(world_array, position, team):
         x, y = position
-        teams = world_array.shape[2]
-        for t in range(teams):
-            if t == team - 1:
-                world_array[x, y, t] = 1
-            else:
-                world_array[x, y, t] = 0
+        return World.change_cells_teams(world_array, [x], [y], [team])
+
+    @staticmethod
+    def change_cells_teams(world_array, xs, ys, teams):
+        # set each cell (xs[i], ys[i]) to teams[i] (0 to kill it) in place,
+        # in a one-hot world array or compact team grid
+        xs, ys, teams = np.asarray(xs), np.asarray(ys), np.asarray(teams)
+        if world_array.ndim == 2:
+            # compact team grid
+            world_array[xs, ys] = teams
+            return world_array
+        world_array[xs, ys] = 0
+        alive = teams != 0
+        world_array[xs[alive], ys[alive], teams[alive] - 1] = 1
         return world_array
 
     @staticmethod
-    def world_array_from_team_grid(team_grid):
-        # TODO: REFACTOR so take a World object or at least a number of teams
-        teams = np.amax(team_grid)
+    def world_array_from_team_grid(team_grid, teams=None):
+        # teams defaults to the highest team left in team_grid
+        if teams is None:
+            teams = np.amax(team_grid)
         x, y = team_grid.shape
         world_array = np.zeros((x, y, teams), dtype=int)
         # fill world_array from team_grid
@@ -172,6 +444,46 @@ class World:
         return team_grid
 
 
+class Diff:
+    """The cells of a team grid that changed from one version of a world to
+    the next, as flat indices with their old and new teams"""
+    def __init__(self, shape, indices, old_teams, new_teams,
+                 from_version=None, to_version=None):
+        self.shape = shape
+        self.indices = indices
+        self.old_teams = old_teams
+        self.new_teams = new_teams
+        self.from_version = from_version
+        self.to_version = to_version
+
+    @staticmethod
+    def between(old_team_grid, new_team_grid, from_version=None,
+                to_version=None, indices=None):
+        # comparing every cell, unless the indices of those that changed are
+        # already known
+        if indices is None:
+            indices = np.flatnonzero(old_team_grid != new_team_grid)
+        return Diff(old_team_grid.shape, indices,
+                    old_team_grid.ravel()[indices],
+                    new_team_grid.ravel()[indices],
+                    from_version, to_version)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def positions(self):
+        # (xs, ys) of the changed cells
+        return np.unravel_index(self.indices, self.shape)
+
+    def changed_mask(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.ravel()[self.indices] = True
+        return mask
+
+    def change_ratio(self):
+        return len(self.indices) / (self.shape[0] * self.shape[1])
+
+
 class Cursor:
     def __init__(self, style=0):
         self.pos = None
@@ -179,12 +491,10 @@ class Cursor:
         self.active = False
         self.style = style
 
-    def update(self, screen_pos, scaling):
+    def update(self, screen_pos, screen):
+        # the cell under screen_pos in screen's view, None if off the world
         if self.active:
-            x, y = screen_pos
-            x = floor(x / scaling)
-            y = floor(y / scaling)
-            self.pos = (x, y)
+            self.pos = screen.cell_at(screen_pos)
 
     def set_team(self, team, colours):
         self.colour = colours.shift_colour(colours.get_team_colour(team),